@@ -0,0 +1,213 @@
+# Backtest.py
+#
+# Historical backtests: how would a product have settled had it been
+# opened on every date of a price history?
+#
+# A contract template (built at some reference price) is rolled forward
+# over a CSV of daily closes.  On each date a contract is opened at that
+# day's close and settled `horizon` rows later.  A product opened at price S
+# is the template with every threshold scaled by S/S_ref, and with its
+# amounts scaled according to which asset the notional is fixed in:
+#
+#   notional="quote"  -  e.g. a 100 USD bond: base-asset amounts scale by S_ref/S
+#   notional="base"   -  e.g. a call on 10000 BTS: quote-asset amounts scale by S/S_ref
+#
+# Since scaling every threshold by S/S_ref is the same as settling the
+# template at close*S_ref/S, all dates in a chunk settle in one vectorized
+# pass of the compiled template.  The file is read in chunks, so histories
+# of any length stream in bounded memory.
+#
+# Usage:
+#
+#   T = BoundedStableCoin.Template("0.10 BTS:USD", 4, 1.10, unit="100 USD")
+#   BT = Backtest(T, "BTS:USD", horizon=30)
+#   R = BT.run("BTSUSD.csv")        # CSV with "date" and "close" columns
+#   R.opendates, R.settledates, R.values[0]   # account 0's value in USD
+#
+#.
+import csv
+import itertools
+import numpy as np
+from HTLCProductsSim import *
+from StudyStore import RateArray
+from ContractTemplate import ContractTemplate, ContractInstance
+
+
+class BacktestResult:
+    #
+    # One row per backtested contract:
+    #
+    #   opendates, settledates  -  lists of date strings
+    #   opens, closes           -  float64 prices at opening and settlement
+    #   values                  -  float64 ndarray (accounts, rows) of account
+    #                              values in `quote` at settlement
+    #
+    def __init__(self, opendates, settledates, opens, closes, values, quote, names):
+        self.opendates = opendates
+        self.settledates = settledates
+        self.opens = opens
+        self.closes = closes
+        self.values = values
+        self.quote = quote
+        self.names = names
+
+    def __len__(self):
+        return len(self.opens)
+
+    @staticmethod
+    def concatenate(results):
+        results = list(results)
+        if not results:
+            raise ValueError("No backtest results")
+        return BacktestResult(
+            [d for r in results for d in r.opendates], [d for r in results for d in r.settledates],
+            np.concatenate([r.opens for r in results]), np.concatenate([r.closes for r in results]),
+            np.concatenate([r.values for r in results], axis=1), results[0].quote, results[0].names)
+
+    def prettyPrint(self, step=1):
+        print("%12s %12s %12s %12s  %s" % ("Opened", "Settled", "Open", "Close",
+                                          "  ".join("%16s" % n[:16] for n in self.names)))
+        for k in range(0, len(self), step):
+            print("%12s %12s %12g %12g  %s" % (self.opendates[k], self.settledates[k],
+                                               self.opens[k], self.closes[k],
+                                               "  ".join("%16.4f" % v for v in self.values[:, k])))
+
+
+class Backtest:
+    #
+    #  template     -  ContractTemplate (or Contract) at the reference price
+    #  pair         -  Pair of the prices in the history file
+    #  horizon      -  Rows (trading days) from opening to settlement
+    #  notional     -  "quote" or "base": asset in which the notional is fixed
+    #  refprice     -  Price at which the template was built; defaults to
+    #                  the template's openingbaseprice
+    #  quote        -  Asset in which to value accounts (default: pair.quote)
+    #  fixedprices  -  Other known prices (list or PriceEnvironment), if any
+    #
+    def __init__(self, template, pair, horizon=1, notional="quote", refprice=None,
+                 quote=None, fixedprices=[]):
+        if isinstance(template, ContractInstance):
+            raise ValueError("Backtest a ContractTemplate or Contract, not an instance")
+        contract = template.contract if isinstance(template, ContractTemplate) else template
+        self.pair = Pair(pair)
+        if refprice is None:
+            refprice = getattr(contract, "openingbaseprice", None)
+        if refprice is None:
+            raise ValueError("No reference price given or found in template")
+        if isinstance(refprice, str):
+            refprice = Price(refprice)
+        if not refprice.pair.compat(self.pair):
+            raise ValueError("Incompatible prices")
+        self.refvalue = refprice.price if refprice.pair.same(self.pair) else 1/refprice.price
+        if notional not in ("quote", "base"):
+            raise ValueError("Notional must be \"quote\" or \"base\"")
+        if horizon < 0:
+            raise ValueError("Negative horizon")
+        self.notional = notional
+        self.horizon = horizon
+        self.quote = quote if quote is not None else self.pair.quote
+        self.fixedprices = list(fixedprices)
+        self.compiled = contract.compile()
+        self.names = [getattr(ac, "name", "Account %d" % i) for i, ac in enumerate(contract.accounts)]
+
+    def settle(self, opens, closes):
+        # float64 ndarray (accounts, N): values in quote of contracts opened at
+        # `opens` and settled at `closes` (arrays of prices in pair units)
+        opens = np.asarray(opens, dtype=float)
+        closes = np.asarray(closes, dtype=float)
+        ratio = opens / self.refvalue                   # S/S_ref
+        balances, _ = self.compiled.settle([(self.pair, closes/ratio)], self.fixedprices)
+        values = np.zeros((self.compiled.naccounts, len(closes)))
+        for s, symbol in enumerate(self.compiled.symbols):
+            if self.notional == "quote" and symbol == self.pair.base:
+                balances[:, s] /= ratio
+            elif self.notional == "base" and symbol == self.pair.quote:
+                balances[:, s] *= ratio
+            rate = RateArray(symbol, self.quote, [(self.pair, closes)], self.fixedprices)
+            with np.errstate(invalid='ignore'):
+                values += np.where(balances[:, s] != 0, balances[:, s]*rate, 0.0)
+        return values
+
+    @staticmethod
+    def readRows(path, datecol="date", pricecol="close"):
+        # Yields (date, price) rows of a CSV file with a header line
+        with open(path, newline="") as f:
+            reader = csv.reader(f)
+            header = [h.strip().lower() for h in next(reader)]
+            try:
+                d, p = header.index(datecol.lower()), header.index(pricecol.lower())
+            except ValueError:
+                raise ValueError("CSV needs \"%s\" and \"%s\" columns" % (datecol, pricecol))
+            for row in reader:
+                if row:
+                    yield row[d].strip(), float(row[p])
+
+    def iterRun(self, rows, chunksize=65536):
+        # Streaming backtest over an iterable of (date, price) rows, or a CSV
+        # path.  Yields one BacktestResult per chunk of opening dates; only
+        # `chunksize + horizon` rows are held at a time.
+        if isinstance(rows, str):
+            rows = Backtest.readRows(rows)
+        rows = iter(rows)
+        dates, prices = [], []
+        while True:
+            need = chunksize + self.horizon - len(prices)
+            chunk = list(itertools.islice(rows, need))
+            for date, price in chunk:
+                dates.append(date)
+                prices.append(price)
+            n = min(len(prices) - self.horizon, chunksize)  # contracts that can settle
+            if n > 0:
+                P = np.array(prices, dtype=float)
+                opens, closes = P[:n], P[self.horizon:self.horizon+n]
+                yield BacktestResult(dates[:n], dates[self.horizon:self.horizon+n], opens, closes,
+                                     self.settle(opens, closes), self.quote, self.names)
+                dates, prices = dates[n:], prices[n:]
+            if len(chunk) < need:
+                return
+
+    def run(self, rows, chunksize=65536):
+        # Whole backtest as a single BacktestResult
+        return BacktestResult.concatenate(self.iterRun(rows, chunksize))
+
+
+if __name__ == "__main__":
+
+    import io, contextlib, os, tempfile, time, datetime
+    from BoundedStableCoin import BoundedStableCoin
+    from OptionSwap import LongCall
+
+    print("\nBacktest Test:\n")
+    rng = np.random.default_rng(1)
+    closes = 0.10*np.exp(np.cumsum(rng.normal(0, 0.04, 20000)))
+    day = datetime.date(1970, 1, 1)
+    path = os.path.join(tempfile.mkdtemp(), "history.csv")
+    with open(path, "w") as f:
+        f.write("date,close\n")
+        for k, c in enumerate(closes):
+            f.write("%s,%r\n" % (day + datetime.timedelta(days=k), float(c)))
+
+    with contextlib.redirect_stdout(io.StringIO()):   # (Face() prints its series)
+        T = BoundedStableCoin.Template("0.10 BTS:USD", 4, 1.10, unit="100 USD")
+    t0 = time.time()
+    R = Backtest(T, "BTS:USD", horizon=30).run(path, chunksize=4096)
+    t1 = time.time()
+    print("BSC, 100 USD face, 30 day horizon: %d contracts in %.2fs" % (len(R), t1-t0))
+    R.prettyPrint(step=5000)
+
+    err = 0
+    for k in [0, 777, 5000, len(R)-1]:
+        with contextlib.redirect_stdout(io.StringIO()):
+            C = BoundedStableCoin.Face("100 USD", Price(R.opens[k], "BTS:USD"), 4, 1.10)
+        final = [Price(R.closes[k], "BTS:USD")]
+        C.conclude(final)
+        err = max(err, max(abs(C.accounts[a].valuation("USD", final).amount - R.values[a, k]) for a in range(2)))
+    print("Max difference vs. contracts built at each opening price: %g USD" % err)
+
+    LC = LongCall(AssetBag("10000 BTS"), Price("0.10 BTS:USD"), 1.15)
+    R = Backtest(LC, "BTS:USD", horizon=30, notional="base", refprice="0.10 BTS:USD").run(path)
+    C = LongCall(AssetBag("10000 BTS"), Price(R.opens[123], "BTS:USD"), 1.15)
+    final = [Price(R.closes[123], "BTS:USD")]
+    C.conclude(final)
+    print("LongCall at-the-money, row 123: backtest %.4f, direct %.4f USD" % (
+        R.values[0, 123], C.accounts[0].valuation("USD", final).amount))
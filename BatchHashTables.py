@@ -0,0 +1,151 @@
+#
+# Batch Hash Table Tool:
+#
+# Usage:    python3 %s <start_date> <end_date> --table <top_price> <tag> [--table ...]
+#           Builds the public hash tables of every table set for every day
+#           from start_date to end_date (inclusive), exactly as
+#           BuildHashTable.py would one at a time, spread over a process
+#           pool.  Pair and Tag-specific config options are read from the
+#           config file (ladder.conf) in sections [<pair> <tag>].\n
+#
+# Example:  python3 %s 200101 200131 --table "32000 BTC:USD" Down --table "0.50 BTS:USD" Down --outdir tables\n
+#           Writes 62 table files to tables/, plus an index of the merkle
+#           roots of every table (tables/merkleroots.json, merged with the
+#           index of earlier runs into the same directory).  With --index,
+#           also adds every table's hashes to a reverse hash index (see
+#           HashIndex.py).\n
+#
+
+import configparser
+import argparse
+import concurrent.futures
+import datetime
+import json
+import os.path
+from HTLCProductsSim import *
+from HashLadder import *
+from BuildHashTable import BuildHashTableList, cfgfile
+from HashIndex import HashIndex
+from LadderCache import LadderCache
+import TableFormatters
+
+parser = argparse.ArgumentParser(
+    description="Batch Hash Table Tool: Make [price, hash] tables for a range of dates and table sets.",
+    epilog="Pair and Tag-specific config option are read from the config file "
+           "(ladder.conf) in sections [<pair> <tag>].")
+parser.add_argument('startdate', metavar="START", help="First target date in YYMMDD")
+parser.add_argument('enddate', metavar="END", help="Last target date in YYMMDD")
+parser.add_argument('--table', nargs=2, action='append', required=True, metavar=("PRICE", "TAG"),
+                    help="Extremum price and table tag, e.g. \"32000 BTC:USD\" Down (repeatable)")
+parser.add_argument('--outdir', default=".", help="Directory to write tables and index to")
+parser.add_argument('--index', help="Reverse hash index file to add the tables to")
+parser.add_argument('--cache', metavar="DIR", help="Ladder cache directory (reuse ladders built before)")
+parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: CPU count)")
+parser.add_argument('--priceargs', help="Additional args to price iterator (json)", default='{}')
+parser.add_argument('--formatargs', help="Additional args to formatter plugin (json)", default='{}')
+
+
+def DateRange(startdate, enddate):
+    # Target dates (YYMMDD strings) from startdate to enddate inclusive
+    start = datetime.datetime.strptime(startdate, "%y%m%d")
+    end = datetime.datetime.strptime(enddate, "%y%m%d")
+    if end < start:
+        raise ValueError("End date precedes start date")
+    return [(start + datetime.timedelta(days=d)).strftime("%y%m%d")
+            for d in range((end - start).days + 1)]
+
+
+def TableFileName(targetdate, topP, tagstring):
+    return "%s_%s-%s_%s.md" % (targetdate, topP.pair.base, topP.pair.quote, tagstring)
+
+
+def _BuildTableSet(job):
+    # Worker: build one table set (as BuildHashTable.py would) and return
+    # (filename, table text, index entries, hash index entries)
+    targetdate, topprice, tagstring, secrettxt, htcfg, mtcfg, add_format, cachedir = job
+    topP = Price(topprice)
+    cache = LadderCache(cachedir) if cachedir is not None else None
+    HT_list = BuildHashTableList(targetdate, topP, secrettxt, htcfg, mtcfg, cache=cache)
+    FT = TableFormatters.GetFMT(htcfg['formatter'], HT_list, **add_format)
+    filename = TableFileName(targetdate, topP, tagstring)
+    entries = [{"date": targetdate,
+                "section": "%s %s" % (topP.pair, tagstring),
+                "flip": HT.PriceItr.flip,
+                "plane": HT.PriceItr.plane,
+                "header": HT.header,
+                "merkleroot": HT.merkleroot.hex(),
+                "file": filename} for HT in HT_list]
+    hashsets = [(HashIndex.TableInfo(HT, filename), list(HT.ladder.hashes)) for HT in HT_list]
+    return filename, FT.constructPublicHashTableText(), entries, hashsets
+
+
+def BuildBatch(dates, tables, cfg, add_price={}, add_format={}, workers=None, cachedir=None):
+    # Yields (filename, table text, index entries, hash index entries) for
+    # every (date, table)
+    # in order: dates outermost, then tables as given.  Table sets are built
+    # on a process pool; results are independent of the number of workers.
+    secrettxt = cfg['default']['secret'].strip('"')
+    jobs = []
+    for targetdate in dates:
+        for topprice, tagstring in tables:
+            section = str(Price(topprice).pair)+" "+tagstring
+            htcfg = ConfigArgsExtractor(cfg[section]).getHashTableArgs()
+            mtcfg = ConfigArgsExtractor(cfg[section]).getMultiTableArgs()
+            htcfg['priceargs'].update(add_price)
+            jobs.append((targetdate, topprice, tagstring, secrettxt, htcfg, mtcfg, add_format, cachedir))
+    if workers is not None and workers <= 1:
+        yield from map(_BuildTableSet, jobs)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(_BuildTableSet, jobs)
+
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+
+    cfgdefaults = {"bidirectional":"False"}
+    cfg = configparser.ConfigParser(cfgdefaults)
+    cfg.read(cfgfile)
+    try:
+        cfg['default']['secret']
+    except:
+        print ("Could not read hash secret from config file '%s'."%cfgfile)
+        quit()
+
+    dates = DateRange(args.startdate, args.enddate)
+    tables = [tuple(t) for t in args.table]
+    for topprice, tagstring in tables:
+        Price(topprice)
+    names = [TableFileName(d, Price(p), t) for d in dates for p, t in tables]
+    existing = [n for n in names if os.path.exists(os.path.join(args.outdir, n))]
+    if existing:
+        print("Output file %s exists. Will not overwrite. Exiting." % existing[0])
+        quit()
+    os.makedirs(args.outdir, exist_ok=True)
+
+    index = []
+    hashsets = []
+    for filename, text, entries, tablehashes in BuildBatch(dates, tables, cfg, json.loads(args.priceargs),
+                                                           json.loads(args.formatargs), args.workers,
+                                                           args.cache):
+        with open(os.path.join(args.outdir, filename), 'w') as table_file:
+            table_file.write(text)
+        index.extend(entries)
+        hashsets.extend(tablehashes)
+    indexfile = os.path.join(args.outdir, "merkleroots.json")
+    nwritten = len(index)
+    if os.path.exists(indexfile):       # (earlier runs into outdir: merge)
+        with open(indexfile) as f:
+            earlier = json.load(f)
+        seen = {(e["file"], e["header"]) for e in index}
+        index = [e for e in earlier if (e["file"], e["header"]) not in seen] + index
+    with open(indexfile, 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+        f.write("\n")
+    print("((( Wrote %d tables (%d table sets) and index %s (%d tables)" % (
+        nwritten, len(names), indexfile, len(index)))
+    if args.index is not None:
+        IX = HashIndex(args.index)
+        IX.add(hashsets)
+        print("((( Indexed %d tables in %s (%d hashes)" % (len(hashsets), args.index, len(IX)))
@@ -139,3 +139,20 @@ class BoundedStableCoin(Contract):
         ret.accounts[1].name = "%s Variabilty Coin"%startvalue
         ret.accounts[1].startvalue = startvalue
         return ret
+
+    @staticmethod
+    def Template(todayprice, upside, tolerance, unit="1 USD"):
+        # Return a ContractTemplate of the BSC schedule at a face value of `unit`,
+        # for issuing the same product at many face values without rebuilding
+        # tranches:
+        #
+        #   T = BoundedStableCoin.Template("0.10 BTS:USD", 4, 1.10)
+        #   T.instance("250 USD")
+        #
+        from ContractTemplate import ContractTemplate
+        if isinstance(unit, str):
+            unit = AssetBag(unit)
+        C = BoundedStableCoin.Face(unit, todayprice, upside, tolerance)
+        C.accounts[0].name = "%s Ranged Bond" % unit.symbol
+        C.accounts[1].name = "%s Variabilty Coin" % C.accounts[1].startvalue.symbol
+        return ContractTemplate(C, unit)
@@ -12,6 +12,10 @@
 # Example:  python3 %s "200110" "32000 BTC:USD" Down 7965.37\n
 #            Prints preimage table for BTC:USD observed price of 7965.37\n
 #
+# Example:  python3 %s "200110" "0.50 BTS:USD" Down --outfile t.md --index hashindex.bin\n
+#           Also records the table's hashes in the reverse index hashindex.bin
+#           (see HashIndex.py), for looking up revealed preimages later.\n
+#
 
 import configparser
 import argparse
@@ -22,6 +26,8 @@ import os.path
 import PriceIterators
 from HTLCProductsSim import *
 from HashLadder import *
+from HashIndex import HashIndex
+from LadderCache import LadderCache
 import TableFormatters
 
 AppBanner = """(((
@@ -40,9 +46,28 @@ parser.add_argument('topprice', metavar="PRICE", help="Extremum (top or bottom)
 parser.add_argument('tagstring', metavar="TAG", help="Table tag, e.g., \"Up\" or \"Down\"")
 parser.add_argument('observedprice', metavar="OBS_PRICE", nargs='?', help="Observed price (numeric, without currency pair)")
 parser.add_argument('--outfile', help="File to write table to (default stdout)")
+parser.add_argument('--cache', metavar="DIR", help="Ladder cache directory (reuse ladders built before)")
+parser.add_argument('--index', help="Reverse hash index file to add published tables to")
 parser.add_argument('--priceargs', help="Additional args to price iterator (json)", default='{}')
 parser.add_argument('--formatargs', help="Additional args to formatter plugin (json)", default='{}')
 
+def BuildHashTableList(targetdate, topP, secrettxt, htcfg, mtcfg, checkpoint=None, cache=None):
+    # The HashTables of one table set: one per (flip, plane), in the order
+    # the formatters print them.
+    HT_list = []
+    for flip in [False, True] if mtcfg['bidirectional'] else [False]:
+        for plane in mtcfg['planes']:
+            PriceIter = PriceIterators.New(
+                startprice=topP.price, **htcfg['priceargs'],
+                plane=plane, flip=flip
+            )
+            HT_list.append(
+                HashTable(targetdate, topP.pair, PriceIter,
+                          secrettxt, htcfg, plane=plane, flip=flip,
+                          checkpoint=checkpoint, cache=cache)
+            )
+    return HT_list
+
 if __name__ == "__main__":
 
     args = parser.parse_args()
@@ -74,17 +99,8 @@ if __name__ == "__main__":
 
     htcfg['priceargs'].update(add_price)
 
-    HT_list = []
-    for flip in [False, True] if mtcfg['bidirectional'] else [False]:
-        for plane in mtcfg['planes']:
-            PriceIter = PriceIterators.New(
-                startprice=topP.price, **htcfg['priceargs'],
-                plane=plane, flip=flip
-            )
-            HT_list.append(
-                HashTable(targetdate, topP.pair, PriceIter,
-                          secrettxt, htcfg, plane=plane, flip=flip)
-            )
+    cache = LadderCache(args.cache) if args.cache is not None else None
+    HT_list = BuildHashTableList(targetdate, topP, secrettxt, htcfg, mtcfg, cache=cache)
 
     FT = TableFormatters.GetFMT(htcfg['formatter'], HT_list, **add_format)
 
@@ -110,6 +126,10 @@ if __name__ == "__main__":
         print("((( You have requested: HASH TABLE from section [%s] target date: %s.\n((("%(section, targetdate))
         check_outfile()
         FT.printPublicHashTable(outfile)
+        if args.index is not None:
+            IX = HashIndex(args.index)
+            IX.addTables(HT_list, source=outfile)
+            print("((( Indexed %d tables in %s (%d hashes)" % (len(HT_list), args.index, len(IX)))
         print("(((\n((( This concludes: HASH TABLE from section [%s] target date: %s.\n((("%(section, targetdate))
 
     if outfile is None:
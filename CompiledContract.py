@@ -0,0 +1,244 @@
+# CompiledContract.py
+#
+# A "compiled" form of a Contract.  The tranche table is flattened into
+# parallel NumPy arrays (threshold, strictness, direction, amount, symbol,
+# and account indices) so that the balance of every account can be worked
+# out over a whole vector of closing prices in one vectorized pass, instead
+# of a reset()/conclude()/copy() cycle per price point.
+#
+# Usage:
+#
+#   CC = CompiledContract(contract)       # or: contract.compile()
+#   bal, first = CC.settle([(pair, values)], fixedprices)
+#
+# or simply:
+#
+#   contract.doStudy(varprices, fixedprices, engine="compiled")
+#
+# In fixed-point mode (AssetBag.setFixedPoint(), or fixedpoint=True) amounts
+# are compiled to int64 units of each symbol's precision and settled in
+# exact integer arithmetic; settleUnits() returns the int64 balances.
+#
+# For sweeps too large to hold in memory, stream the results in chunks:
+#
+#   for chunk in contract.iterStudy(varprices, fixedprices):
+#       for price, balances in chunk.records(): ...
+#
+# Results are identical to the default (looping) study, including the order
+# in which each Account view holds its AssetBags.
+#
+#.
+import itertools
+import numpy as np
+from HTLCProductsSim import *
+from StudyStore import StudyStore
+
+
+def PriceVector(prices):
+    # Split a sequence of Price objects sharing one pair into (Pair, ndarray).
+    # Returns (None, empty array) for an empty sequence.
+    if isinstance(prices, PriceRange):  # (no Price objects needed)
+        return (prices.pair, prices.values()) if len(prices) else (None, np.zeros(0))
+    prices = list(prices)
+    if len(prices) == 0:
+        return None, np.zeros(0)
+    pair = prices[0].pair
+    for p in prices:
+        if not p.pair.same(pair):
+            raise ValueError("Study prices must share one currency pair")
+    return pair, np.fromiter((p.price for p in prices), dtype=float, count=len(prices))
+
+
+class CompiledContract:
+    #
+    # Flattened, array-based representation of a Contract's tranches.
+    #
+    # Per-tranche arrays (length = number of tranches):
+    #
+    #   threshold  -  threshold price value (float64), in units of pairs[i]
+    #   strict     -  OracleHash.strict (bool)
+    #   exceeds    -  OracleHash.exceeds (bool)
+    #   amount     -  disbursed amount (float64)
+    #   units      -  disbursed amount in integer units (int64), or None
+    #                 unless compiled in fixed-point mode
+    #   symbol     -  index into self.symbols (int)
+    #   taccount   -  index into contract.accounts of timeout recipient (int)
+    #   haccount   -  index into contract.accounts of hash recipient (int)
+    #
+    # Tranches whose oracle is a user subclass of OracleHash are evaluated
+    # by calling their own isRevealed() at each price (slow, but correct).
+    #
+    def __init__(self, contract, fixedpoint=None):
+        if fixedpoint is None:
+            fixedpoint = AssetBag.fixedpoint
+        self.contract = contract
+        self.naccounts = len(contract.accounts)
+        acctidx = {id(a): i for i, a in enumerate(contract.accounts)}
+        self.symbols = []
+        symidx = {}
+        self.pairs = []
+        self.oracles = []
+        threshold, strict, exceeds, amount, symbol, taccount, haccount = [], [], [], [], [], [], []
+        for t in contract.tranches:
+            if id(t.taccount) not in acctidx or id(t.haccount) not in acctidx:
+                raise ValueError("Tranche disburses to an account not in contract")
+            if t.asset.symbol not in symidx:
+                symidx[t.asset.symbol] = len(self.symbols)
+                self.symbols.append(t.asset.symbol)
+            self.pairs.append(t.ohash.threshprice.pair)
+            self.oracles.append(t.ohash)
+            threshold.append(t.ohash.threshprice.price)
+            strict.append(t.ohash.strict)
+            exceeds.append(t.ohash.exceeds)
+            amount.append(t.asset.amount)
+            symbol.append(symidx[t.asset.symbol])
+            taccount.append(acctidx[id(t.taccount)])
+            haccount.append(acctidx[id(t.haccount)])
+        self.threshold = np.array(threshold, dtype=float)
+        self.strict = np.array(strict, dtype=bool)
+        self.exceeds = np.array(exceeds, dtype=bool)
+        self.amount = np.array(amount, dtype=float)
+        self.symbol = np.array(symbol, dtype=int)
+        self.taccount = np.array(taccount, dtype=int)
+        self.haccount = np.array(haccount, dtype=int)
+        self.units = None
+        if fixedpoint:
+            self.units = np.array([AssetBag.toUnits(a, self.symbols[s]) for a, s in zip(amount, symbol)],
+                                  dtype=np.int64)
+            self.unitsize = np.array([10**AssetBag.precisions[s] for s in self.symbols], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.threshold)
+
+    def __getstate__(self):
+        # Pickle (e.g. for worker processes) without the source contract
+        state = dict(self.__dict__)
+        state['contract'] = None
+        return state
+
+    def revealed(self, i, varying, fixedprices=[]):
+        # Reveal state of tranche i.  Returns a bool array when the tranche is
+        # conditioned on one of the `varying` (Pair, values) axes, or a plain
+        # bool when it is conditioned on a price in `fixedprices`.  Mirrors
+        # HashTranche.disburse(): first compatible price wins, varying axes
+        # taking precedence.
+        tpair = self.pairs[i]
+        for pair, values in varying:
+            if pair.compat(tpair):
+                return self.oracles[i].isRevealedMany(values, pair)
+        price = PriceEnvironment.lookup(fixedprices, tpair)
+        if price is None:
+            raise ValueError("No compatible price in knownprices")
+        return bool(self.oracles[i].isRevealed(price))
+
+    def settle(self, varying, fixedprices=[]):
+        # Settle the contract at every point of the `varying` axes at once.
+        #
+        # varying:     list of (Pair, ndarray) tuples, all arrays of equal length N
+        # fixedprices: additional external price data, if any
+        #
+        # Returns (balances, first), both shaped (accounts, symbols, N):
+        #
+        #   balances  -  float64 amount of each symbol held by each account
+        #   first     -  index of the tranche that first delivered that symbol
+        #                to that account, or len(self) if none did.  (This
+        #                reproduces the bag order of Account.receive().)
+        #
+        if self.units is not None:
+            units, first = self.settleUnits(varying, fixedprices)
+            return units / self.unitsize[None, :, None], first
+        return self._settle(self.amount, varying, fixedprices)
+
+    def settleUnits(self, varying, fixedprices=[]):
+        # As settle(), but balances are exact int64 units (fixed-point mode
+        # only; divide by .unitsize per symbol for amounts).
+        if self.units is None:
+            raise ValueError("Contract not compiled in fixed-point mode")
+        return self._settle(self.units, varying, fixedprices)
+
+    def _settle(self, amounts, varying, fixedprices):
+        npoints = len(varying[0][1]) if len(varying) > 0 else 1
+        ntranches = len(self)
+        shape = (self.naccounts, len(self.symbols), npoints)
+        balances = np.zeros(shape, dtype=amounts.dtype)
+        first = np.full(shape, ntranches, dtype=np.int32)
+        for i in range(ntranches):
+            rev = self.revealed(i, varying, fixedprices)
+            s = self.symbol[i]
+            for acct, mask in ((self.haccount[i], rev), (self.taccount[i], np.logical_not(rev))):
+                if isinstance(mask, np.ndarray):
+                    balances[acct, s] += np.where(mask, amounts[i], 0)
+                    np.minimum(first[acct, s], np.where(mask, i, ntranches), out=first[acct, s])
+                elif mask:
+                    balances[acct, s] += amounts[i]
+                    np.minimum(first[acct, s], i, out=first[acct, s])
+        return balances, first
+
+    def study(self, varprices, fixedprices=[]):
+        # Compiled equivalent of Contract.doStudy(): returns a StudyStore of
+        # the balances of every account at each price in varprices.
+        pair, values = PriceVector(varprices)
+        if pair is None:
+            return StudyStore.empty(None, values, self.naccounts, self.symbols)
+        balances, first = self.settle([(pair, values)], fixedprices)
+        return StudyStore.fromSettlement(pair, values, self.symbols, balances, first, len(self))
+
+    def iterStudy(self, varprices, fixedprices=[], chunksize=4096):
+        # Streaming study: consumes any iterable of prices lazily and yields
+        # one StudyStore per chunk of at most `chunksize` points.  Memory use
+        # is bounded by the chunk size, whatever the length of the sweep.
+        fixedprices = PriceEnvironment.wrap(fixedprices)
+        varprices = iter(varprices)
+        start = 0
+        while True:
+            chunk = list(itertools.islice(varprices, chunksize))
+            if not chunk:
+                return
+            store = self.study(chunk, fixedprices)
+            store.start = start
+            start += len(chunk)
+            yield store
+
+if __name__ == "__main__":
+
+    print("\nCompiled Study Test:\n")
+    C = Contract()
+    C.addNAccounts(2)
+    for p in [12, 11, 10, 9, 8]:
+        C.addTranche(OracleHash.GT(Price(p, "USD:BTS")), "100 BTS")
+    C.addTranche(OracleHash.LE("0.1 BTS:USD"), "50 USD", 1, 0)
+
+    P = Price.linspace(7, 13, 13, "USD:BTS")
+    C.doStudy(P)
+    looped = [[str(b) for a in ac.StudyResults for b in a.bags] for ac in C.accounts]
+    C.doStudy(P, engine="compiled")
+    compiled = [[str(b) for a in ac.StudyResults for b in a.bags] for ac in C.accounts]
+    print("Engines agree: %s" % (looped == compiled))
+
+    print("\nStreaming Study Test:\n")
+    lazy = (Price(7 + i/1000, "USD:BTS") for i in range(6001))
+    total = 0
+    for chunk in C.iterStudy(lazy, chunksize=2000):
+        print("Chunk at %d: %d points, mean BTS of account 1: %g" % (
+            chunk.start, len(chunk), chunk.column(1, "BTS").mean()))
+        total += len(chunk)
+    price, balances = next(next(C.iterStudy(P)).records())
+    print("%d points streamed; first record: %s %s" % (total, price, balances))
+
+    print("\nFixed-Point Study Test:\n")
+    AssetBag.setPrecision("BTS", 5)
+    AssetBag.setPrecision("USD", 4)
+    AssetBag.setFixedPoint()
+    F = Contract()
+    F.addNAccounts(2)
+    for i in range(200):
+        F.addTranche(OracleHash.GE(Price(8 + i/50, "USD:BTS")), AssetBag(0.1 + i/3e3, "BTS"))
+    P = Price.linspace(7, 13, 301, "USD:BTS")
+    F.doStudy(P)
+    looped = [[dict(a.balances) for a in ac.StudyResults] for ac in F.accounts]
+    F.doStudy(P, engine="compiled")
+    compiled = [[dict(a.balances) for a in ac.StudyResults] for ac in F.accounts]
+    units, _ = F.compile().settleUnits([PriceVector(P)])
+    print("Engines agree exactly: %s; int64 units of account 1 at %s: %d" % (
+        looped == compiled, P[150], units[1, 0, 150]))
+    AssetBag.setFixedPoint(False)
@@ -0,0 +1,245 @@
+# ContractTemplate.py
+#
+# Template/instance split for product lines issued at many notionals.
+#
+# A ContractTemplate is an immutable tranche schedule at unit scale: the
+# oracles, the asset amounts, and which account slot each tranche pays.  A
+# ContractInstance binds a template to its own accounts and a scalar
+# notional.  Settlements and studies run once on the template and are
+# scaled for each instance, so a product issued at hundreds of face values
+# holds one set of tranches and is studied once.
+#
+# Usage:
+#
+#   T = BoundedStableCoin.Template("0.10 BTS:USD", 4, 1.10)  # 1 USD face value
+#   I = T.instance("250 USD")           # or: T.instance(250)
+#   I.conclude(knownprices)             # deposits into I.accounts
+#   I.doStudy(varprices)                # template study, scaled view
+#   ProductPlot(I, 0, "USD")
+#
+# Any Contract can serve as a template:  ContractTemplate(contract) or
+# contract.template().  Amounts of an instance agree with those of a
+# contract built directly at that notional to within floating-point
+# rounding.
+#
+#.
+from HTLCProductsSim import *
+
+
+def _ScaledMetadata(source, target, scale):
+    # Copy account baggage (names, face values...) scaling any AssetBags
+    for key, value in vars(source).items():
+        if key in ("balances", "StudyResults"):
+            continue
+        if isinstance(value, AssetBag):
+            scaled = AssetBag(value.amount*scale, value.symbol)
+            if hasattr(value, "label"):
+                scaled.label = value.label
+            value = scaled
+        setattr(target, key, value)
+
+
+def _Snapshot(contract, scale=1):
+    # Returns a new Contract with the same schedule as `contract`, amounts
+    # multiplied by `scale`, fresh accounts, and the metadata of the contract
+    # (e.g. openingbaseprice, strikeprice) and its accounts carried over.
+    acctidx = {id(a): i for i, a in enumerate(contract.accounts)}
+    C = Contract()
+    C.addNAccounts(len(contract.accounts))
+    for src, ac in zip(contract.accounts, C.accounts):
+        _ScaledMetadata(src, ac, scale)
+    for t in contract.tranches:
+        if id(t.taccount) not in acctidx or id(t.haccount) not in acctidx:
+            raise ValueError("Tranche disburses to an account not in contract")
+        C.addTranche(t.ohash, AssetBag(t.asset.amount*scale, t.asset.symbol),
+                     acctidx[id(t.taccount)], acctidx[id(t.haccount)])
+    for key, value in vars(contract).items():
+        if key not in vars(C) and not key.startswith("Study"):
+            setattr(C, key, value)
+    return C
+
+
+def _SameStudyPrices(X, store, varprices):
+    # Whether varprices are the X axis of a study (X as passed, store its
+    # StudyStore): PriceRanges by their parameters, anything else by value
+    if isinstance(varprices, PriceRange):
+        return isinstance(X, PriceRange) and all(
+            getattr(X, k) == getattr(varprices, k) for k in PriceRange.__slots__)
+    from CompiledContract import PriceVector
+    import numpy as np
+    pair, values = PriceVector(varprices)
+    return (pair is None or pair.same(store.xpair)) and np.array_equal(values, store.X)
+
+
+class ContractTemplate:
+    #
+    #  contract  -  Contract whose schedule to freeze (it is copied; later
+    #               changes to it do not affect the template)
+    #  notional  -  (AssetBag or string, optional) what scale 1 stands for,
+    #               so that instances may be given as e.g. "250 USD"
+    #
+    def __init__(self, contract, notional=None):
+        if isinstance(notional, str):
+            notional = AssetBag(notional)
+        self.notional = notional
+        self.contract = _Snapshot(contract)    # private: accounts are scratch space
+        self.naccounts = len(self.contract.accounts)
+        self._settled = (None, None)           # (price key, balances) of last settle
+        self._studied = (None, None)           # ((fixedprices, engine), StudyStore) of last study
+
+    def __len__(self):
+        return len(self.contract.tranches)
+
+    def scaleOf(self, notional):
+        # Scale factor of an instance with the given notional
+        if isinstance(notional, str):
+            notional = AssetBag(notional)
+        if not isinstance(notional, AssetBag):
+            return notional
+        if self.notional is None:
+            raise ValueError("Template has no notional")
+        if notional.symbol != self.notional.symbol:
+            raise ValueError("Notional must be in %s" % self.notional.symbol)
+        return notional.amount / self.notional.amount
+
+    def instance(self, notional, accounts=None):
+        # New ContractInstance at `notional` (a scale factor, or an AssetBag
+        # or string in the template's notional asset)
+        return ContractInstance(self, self.scaleOf(notional), accounts)
+
+    def settle(self, knownprices):
+        # List of {symbol: amount} per account slot at unit scale.  The
+        # result of the last call is reused while called again with the same
+        # prices, so many instances concluded together settle once.
+        key = [(p.price, str(p.pair)) for p in knownprices]
+        last, balances = self._settled
+        if last != key:
+            self.contract.reset()
+            self.contract.conclude(knownprices, indexed=True)
+            balances = [dict(ac.balances) for ac in self.contract.accounts]
+            self.contract.reset()
+            self._settled = (key, balances)
+        return balances
+
+    def study(self, varprices, fixedprices=[], engine="compiled"):
+        # StudyStore of the template at unit scale (see Contract.doStudy).
+        # Reused while called again with the same prices and engine.  The
+        # X axis of the study, as passed, is .contract.StudyX.
+        if iter(varprices) is varprices:    # (one-shot iterator)
+            varprices = list(varprices)
+        key = ([(p.price, str(p.pair)) for p in fixedprices], engine)
+        last, store = self._studied
+        if last != key or not _SameStudyPrices(self.contract.StudyX, store, varprices):
+            self.contract.doStudy(varprices, fixedprices, engine)
+            store = self.contract.Study
+            self._studied = (key, store)
+        return store
+
+
+class ContractInstance:
+    #
+    # One issue of a ContractTemplate: its own accounts and a scale factor.
+    # Offers the settlement and study interface of a Contract.
+    #
+    #  template  -  ContractTemplate
+    #  scale     -  Multiplier applied to every tranche amount
+    #  accounts  -  Accounts to bind (default: new Accounts, carrying the
+    #               template's account metadata, scaled)
+    #
+    def __init__(self, template, scale, accounts=None):
+        self.template = template
+        self.scale = scale
+        if accounts is None:
+            accounts = []
+            for src in template.contract.accounts:
+                ac = Account()
+                _ScaledMetadata(src, ac, scale)
+                accounts.append(ac)
+        if len(accounts) != template.naccounts:
+            raise ValueError("Template has %d accounts" % template.naccounts)
+        self.accounts = accounts
+        self.pricelistcache = []
+        base = vars(Contract())
+        for key, value in vars(template.contract).items():   # (openingbaseprice, etc.)
+            if key not in base and not key.startswith("Study"):
+                setattr(self, key, value)
+
+    def reset(self): # mutates
+        for acc in self.accounts:
+            acc.empty()
+
+    def conclude(self, finalprices): # mutates
+        # (In fixed-point mode scaled amounts are quantized tranche by
+        # tranche, as in a contract built at this scale, so settle that.)
+        self.pricelistcache = finalprices
+        if AssetBag.fixedpoint:
+            self.contract().conclude(finalprices)
+            return
+        for ac, balances in zip(self.accounts, self.template.settle(finalprices)):
+            for symbol, amount in balances.items():
+                ac.deposit(symbol, amount*self.scale)
+
+    def doStudy(self, varprices, fixedprices = [], engine="compiled"): # mutates
+        # As Contract.doStudy(), from the template's study scaled by .scale
+        # (a view: the instance shares the template's arrays and StudyX)
+        if AssetBag.fixedpoint:         # (quantized per tranche; see conclude())
+            C = self.contract()
+            C.doStudy(varprices, fixedprices, engine)
+            self.Study, self.StudyX, self.StudyPriceEnv = C.Study, C.StudyX, C.StudyPriceEnv
+            return
+        store = self.template.study(varprices, fixedprices, engine).scaled(self.scale)
+        for a, ac in enumerate(self.accounts):
+            ac.StudyResults = store.results(a)
+        self.Study = store
+        self.StudyX = self.template.contract.StudyX
+        self.StudyPriceEnv = fixedprices
+
+    def contract(self):
+        # Materialize as a stand-alone Contract (bound to this instance's
+        # accounts) for code that needs tranches of its own
+        C = _Snapshot(self.template.contract, self.scale)
+        for tr in C.tranches:
+            tr.taccount = self.accounts[C.accounts.index(tr.taccount)]
+            tr.haccount = self.accounts[C.accounts.index(tr.haccount)]
+        C.accounts = self.accounts
+        C.changed()
+        return C
+
+
+if __name__ == "__main__":
+
+    import io, contextlib, time
+    from BoundedStableCoin import BoundedStableCoin
+
+    print("\nContract Template Test:\n")
+    with contextlib.redirect_stdout(io.StringIO()):   # (Face() prints its series)
+        T = BoundedStableCoin.Template("0.10 BTS:USD", 4, 1.10)
+        direct = BoundedStableCoin.Face("250 USD", "0.10 BTS:USD", 4, 1.10)
+    I = T.instance("250 USD")
+
+    final = [Price("0.083 BTS:USD")]
+    I.conclude(final)
+    direct.conclude(final)
+    for a in range(2):
+        print("%-24s instance %s, direct %s" % (I.accounts[a].name,
+              I.accounts[a].valuation("USD", final), direct.accounts[a].valuation("USD", final)))
+
+    P = Price.linspace(0.01, 0.5, 2000, "BTS:USD")
+    faces = range(100, 600)
+    t0 = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for f in faces:
+            BoundedStableCoin.Face("%d USD" % f, "0.10 BTS:USD", 4, 1.10).doStudy(P, engine="compiled")
+    t1 = time.time()
+    for f in faces:
+        I = T.instance(AssetBag(f, "USD"))
+        I.doStudy(P)
+    t2 = time.time()
+    print("\n%d face values studied: one contract each %.2fs, template instances %.2fs" % (
+        len(faces), t1-t0, t2-t1))
+    with contextlib.redirect_stdout(io.StringIO()):
+        direct = BoundedStableCoin.Face("%d USD" % faces[-1], "0.10 BTS:USD", 4, 1.10)
+    direct.doStudy(P, engine="compiled")
+    import numpy as np
+    print("Max relative difference: %g" % np.max(np.abs(I.Study.valuation(0, "USD") /
+                                                      direct.Study.valuation(0, "USD") - 1)))
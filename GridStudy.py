@@ -0,0 +1,138 @@
+# GridStudy.py
+#
+# N-dimensional studies: one price axis per currency pair, evaluated over
+# the full Cartesian grid of axis prices.
+#
+# Where Contract.doStudy() sweeps a single price axis with every other
+# pair held fixed, a GridStudy settles a contract at every combination of
+# prices of several pairs (e.g. USD:BTS and CNY:BTS), for surfaces of
+# account value in some quote asset.  The grid is flattened, cut into
+# chunks, and the chunks are settled by the vectorized CompiledContract
+# engine, optionally on a process pool.
+#
+# Usage:
+#
+#   GS = GridStudy(contract, [Price.linspace(5, 15, 200, "USD:BTS"),
+#                             Price.linspace(1, 3, 100, "CNY:BTS")])
+#   GS.run(workers=4)
+#   GS.balances                  # ndarray (200, 100, accounts, symbols)
+#   GS.valuation(0, "USD")       # ndarray (200, 100)
+#
+#.
+import concurrent.futures
+import numpy as np
+from HTLCProductsSim import *
+from CompiledContract import PriceVector
+from StudyStore import RateArray
+
+
+def _SettleChunk(args):
+    # Worker: settle flat grid indices [start, stop)
+    compiled, axes, fixedprices, start, stop = args
+    coords = np.unravel_index(np.arange(start, stop), tuple(len(v) for _, v in axes))
+    varying = [(pair, values[idx]) for (pair, values), idx in zip(axes, coords)]
+    balances, _ = compiled.settle(varying, fixedprices)
+    return start, balances
+
+
+class GridStudy:
+    #
+    #  contract     -  Any Contract
+    #  axes         -  List of price sequences, each sharing one pair; pairs
+    #                  must be distinct (and not inverses of each other)
+    #  fixedprices  -  Other known prices (list or PriceEnvironment), if any
+    #
+    # After .run():
+    #
+    #   balances  -  float64 ndarray (n1, ..., nk, accounts, symbols)
+    #   symbols   -  list of asset symbols
+    #
+    def __init__(self, contract, axes, fixedprices=[]):
+        self.compiled = contract.compile()
+        self.axes = [PriceVector(prices) for prices in axes]
+        for i, (pair, values) in enumerate(self.axes):
+            if pair is None:
+                raise ValueError("Empty study axis")
+            for other, _ in self.axes[:i]:
+                if pair.compat(other):
+                    raise ValueError("Study axes must have distinct pairs")
+        self.fixedprices = list(fixedprices)
+        self.shape = tuple(len(values) for _, values in self.axes)
+        self.symbols = self.compiled.symbols
+        self.balances = None
+
+    def __len__(self):
+        return int(np.prod(self.shape))
+
+    def run(self, workers=None, chunksize=65536): # mutates
+        # Settle every grid point.  workers: number of worker processes
+        # (None or 1 for in-process).
+        npoints = len(self)
+        flat = np.zeros((self.compiled.naccounts, len(self.symbols), npoints))
+        jobs = [(self.compiled, self.axes, self.fixedprices, start, min(start+chunksize, npoints))
+                for start in range(0, npoints, chunksize)]
+        if workers is None or workers <= 1:
+            results = map(_SettleChunk, jobs)
+            self._gather(flat, results)
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                self._gather(flat, pool.map(_SettleChunk, jobs))
+        grid = flat.reshape((self.compiled.naccounts, len(self.symbols)) + self.shape)
+        self.balances = np.moveaxis(grid, (0, 1), (-2, -1))
+        return self
+
+    @staticmethod
+    def _gather(flat, results):
+        for start, balances in results:
+            flat[:, :, start:start+balances.shape[2]] = balances
+
+    def grid(self, i):
+        # Prices of axis i, shaped to broadcast against the grid
+        shape = [1]*len(self.shape)
+        shape[i] = self.shape[i]
+        return self.axes[i][1].reshape(shape)
+
+    def column(self, acct, symbol):
+        # ndarray (n1, ..., nk) balance of `symbol` held by account `acct`
+        return self.balances[..., acct, self.symbols.index(symbol)]
+
+    def valuation(self, acct, quote):
+        # ndarray (n1, ..., nk) value of account `acct` in units of `quote`
+        varying = [(pair, self.grid(i)) for i, (pair, _) in enumerate(self.axes)]
+        value = np.zeros(self.shape)
+        for s, symbol in enumerate(self.symbols):
+            bal = self.balances[..., acct, s]
+            rate = RateArray(symbol, quote, varying, self.fixedprices)
+            with np.errstate(invalid='ignore'):
+                value += np.where(bal != 0, bal*rate, 0.0)
+        return value
+
+
+if __name__ == "__main__":
+
+    import time
+
+    print("\nGrid Study Test:\n")
+    C = Contract()
+    C.addNAccounts(2)
+    for p in [8, 10, 12]:
+        C.addTranche(OracleHash.GE(Price(p, "USD:BTS")), "100 BTS")
+    for p in [1.5, 2.0, 2.5]:
+        C.addTranche(OracleHash.LT(Price(p, "CNY:BTS")), "40 CNY", 1, 0)
+
+    usd = Price.linspace(6, 14, 300, "USD:BTS")
+    cny = Price.linspace(1, 3, 200, "CNY:BTS")
+    t0 = time.time()
+    GS = GridStudy(C, [usd, cny]).run()
+    t1 = time.time()
+    GS4 = GridStudy(C, [usd, cny]).run(workers=4, chunksize=10000)
+    t2 = time.time()
+    V = GS.valuation(1, "USD")
+    print("Grid %s: serial %.3fs, 4 workers %.3fs, identical: %s" % (
+        GS.shape, t1-t0, t2-t1, np.array_equal(GS.balances, GS4.balances)))
+
+    i, j = 150, 120
+    C.reset()
+    C.conclude([usd[i], cny[j]])
+    print("Point check at %s, %s: grid %g, conclude %s" % (
+        usd[i], cny[j], V[i, j], C.accounts[1].valuation("USD", [usd[i], cny[j]])))
@@ -18,34 +18,41 @@ class ProductPlot:
         self.X = contract.StudyX
         self.contract = contract
         self.product = contract.accounts[acct_idx] # actually Account but with "product metadata" baggage attached
-        self.Y = [y.valuation(quote, [x]+contract.StudyPriceEnv) for x,y in zip(self.X, self.product.StudyResults)]
+        self.xpair = contract.Study.xpair          # Study arrays read directly (see StudyStore.py)
+        self.Xv = contract.Study.X
+        self.Yv = contract.Study.valuation(acct_idx, quote, contract.StudyPriceEnv)
         self.productname = self.product.name if hasattr(self.product,"name") else "Default"
         self.openingbaseprice = contract.openingbaseprice if hasattr(contract, "openingbaseprice") else None
         self.plt = plt # Duck access??
 
+    @property
+    def Y(self):
+        # Product valuations as a list of AssetBags (for older callers)
+        return [AssetBag(float(y), self.quote) for y in self.Yv]
+
     def draw(self):
         self.initAxes()
         self.drawPriceAnnotations()
-        plt.plot([x.price for x in self.X], [y.amount for y in self.Y], label="Closing Value", color="navy")
+        plt.plot(self.Xv, self.Yv, label="Closing Value", color="navy")
         plt.legend()
 
     def initAxes(self):
         plt.gcf().set_size_inches(6.9,4.8, forward=True)
         plt.gca().set_facecolor(ProductPlot.facecolors.get(self.quote, ProductPlot.facecolors["default"]))
-        plt.xlabel("Closing Base Price (%s)" % str(self.X[0].pair), fontweight="bold")
-        plt.ylabel("Product Value (%s)" % self.Y[0].symbol, fontweight="bold")
+        plt.xlabel("Closing Base Price (%s)" % str(self.xpair), fontweight="bold")
+        plt.ylabel("Product Value (%s)" % self.quote, fontweight="bold")
         plt.title("%s - Value at Close" % self.productname, fontweight="bold")
 
     def drawPriceAnnotations(self):
         # Draws todayprice and face value
-        if hasattr(self.product, "startvalue") and self.product.startvalue.compatible(self.Y[0]):
-            xmin = min(self.X).price
-            xmax = max(self.X).price
+        if hasattr(self.product, "startvalue") and self.product.startvalue.symbol == self.quote:
+            xmin = self.Xv.min()
+            xmax = self.Xv.max()
             y = self.product.startvalue.amount
             plt.plot([xmin, xmax], [y, y], label="Opening Value", color="cornflowerblue", dashes=[6, 2], linewidth=1.0)
-        if hasattr(self.product, "facevalue") and self.product.facevalue.compatible(self.Y[0]):
-            xmin = min(self.X).price
-            xmax = max(self.X).price
+        if hasattr(self.product, "facevalue") and self.product.facevalue.symbol == self.quote:
+            xmin = self.Xv.min()
+            xmax = self.Xv.max()
             y = self.product.facevalue.amount
             label = self.product.facevalue.label if hasattr(self.product.facevalue, "label") else "Face Value"
             plt.plot([xmin, xmax], [y, y], label=label, color="royalblue", dashes=[4, 2])
@@ -58,15 +65,15 @@ class ProductPlot:
                          color="lightsteelblue", linewidth=0.75, dashes=[3, 3])
                 plt.plot([xmin, xmax], [ybot, ybot], color="lightsteelblue", linewidth=0.75, dashes=[3, 3])
         # Opening Base Price:
-        if self.openingbaseprice is not None and self.openingbaseprice.pair.same(self.X[0].pair):
+        if self.openingbaseprice is not None and self.openingbaseprice.pair.same(self.xpair):
             x = self.openingbaseprice.price
-            ymax = max(self.Y).amount
+            ymax = self.Yv.max()
             plt.plot([x, x], [0, ymax], color="sienna", linewidth=1.25, dashes=[4, 3])
             plt.text(x, ymax/40, " Opening Base Price", color="sienna")
         # Strikeprice:
-        if hasattr(self.contract, "strikeprice") and self.contract.strikeprice.pair.same(self.X[0].pair):
+        if hasattr(self.contract, "strikeprice") and self.contract.strikeprice.pair.same(self.xpair):
             x = self.contract.strikeprice.price
-            ymax = max(self.Y).amount
+            ymax = self.Yv.max()
             plt.plot([x, x], [0, ymax], color="sienna", linewidth=1.25, dashes=[4, 3])
             plt.text(x, ymax/40, " Strike Price", color="sienna")
 
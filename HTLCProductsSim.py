@@ -10,10 +10,15 @@
 #
 #   class Pair         - A currency pair (e.g. "USD:CNY")
 #   class Price        - A price of one currency in another
+#   class PriceRange   - A lazy, sliceable sequence of evenly (or log-) spaced Prices
+#   class PriceEnvironment - A set of known prices, indexed by pair
 #   class AssetBag     - A quantity of a currency
-#   class Account      - A collection of quantities of currencies
+#   class Account      - A collection of quantities of currencies (symbol -> amount)
 #   class OracleHash   - A "hash" with a condition on preimage revelation
 #   class HashTranche  - An HTLC contract using an OracleHash
+#   class ThresholdIndex - Sorted index of tranche thresholds, for fast settlement
+#   class IncrementalSettlement - Re-settles a contract tick by tick, flipping
+#                        only the tranches whose thresholds were crossed
 #   class Contract ... - A collection of HashTranches and destination accounts.
 #                        May also be populated with metadata to guide plotting
 #                        and introspection of contracts.
@@ -26,26 +31,65 @@
 # BoundedStableCoin.py for an example.
 #
 #.
+import bisect
 
 class Pair:
     # A currency pair, e.g. "USD:BTS".
     # Represents, validates, and compares currency pairs.
-    def __init__(self, pairstring):
-        symbols = pairstring.split(':')
-        if len(symbols) != 2:
-            raise ValueError("Symbol count != 2")
-        for sym in symbols:
-            AssetBag.assertSymbolValid(sym)
-        self.base = symbols[0]
-        self.quote = symbols[1]
+    #
+    # Pairs are immutable and interned: every Pair("USD:BTS") is the same
+    # object, so symbols are validated only once per pair and swap() is
+    # cached.
+    __slots__ = ("base", "quote", "_swapped", "__weakref__")
+    _interned = {}   # (base, quote) -> Pair
+    _bystring = {}   # pairstring -> Pair
+
+    def __new__(cls, pairstring):
+        if isinstance(pairstring, Pair):
+            return pairstring
+        pair = Pair._bystring.get(pairstring)
+        if pair is None:
+            symbols = pairstring.split(':')
+            if len(symbols) != 2:
+                raise ValueError("Symbol count != 2")
+            pair = Pair.intern(symbols[0], symbols[1])
+            Pair._bystring[pairstring] = pair
+        return pair
+
+    @staticmethod
+    def intern(base, quote):
+        # Returns the unique Pair for (base, quote), creating it if needed
+        pair = Pair._interned.get((base, quote))
+        if pair is None:
+            for sym in (base, quote):
+                AssetBag.assertSymbolValid(sym)
+            pair = object.__new__(Pair)
+            pair.base = base
+            pair.quote = quote
+            pair._swapped = None
+            Pair._interned[(base, quote)] = pair
+        return pair
+
+    def __reduce__(self):       # (re-interns on unpickle)
+        return (Pair, (str(self),))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
 
     def __str__(self):
         return self.base + ':' + self.quote
 
     def swap(self):
-        return Pair(self.quote+':'+self.base)
+        if self._swapped is None:
+            self._swapped = Pair.intern(self.quote, self.base)
+        return self._swapped
 
     def compat(self, other):
+        if self is other:
+            return True
         if self.base == other.base and self.quote == other.quote:
             return True
         if self.base == other.quote and self.quote == other.base:
@@ -53,6 +97,8 @@ class Pair:
         return False
 
     def same(self, other):
+        if self is other:
+            return True
         if self.base == other.base and self.quote == other.quote:
             return True
         return False
@@ -71,31 +117,35 @@ class Price:
     #  Price(   20, "USD:BTS")   means:  One USD costs 20 BTS
     #  Price( 0.05, "BTS:USD")   means:  One BTS costs 0.05 USD
     #  Price("20 USD:BTS")       alias for: Price(20, "USD:BTS")
+    #  Price(20, Pair("USD:BTS")) also works
     #
+    __slots__ = ("price", "pair")
+
     def __init__(self, price, pairstring=None):
         if isinstance(price, str):
             temp = Price.fromString(price)
             price = temp.price
-            pairstring = str(temp.pair)
+            pairstring = temp.pair
         self.price = price
         self.pair = Pair(pairstring)
 
     @staticmethod
     def linspace(start, finish, numel, pairstring):
+        pair = Pair(pairstring)
         prices = [start + (finish-start)*i/(numel-1) for i in range(numel)]
-        return [Price(p, pairstring) for p in prices]
+        return [Price(p, pair) for p in prices]
 
     def __str__(self):
         return "%g %s" % (self.price, self.pair)
 
     def flip(self):
-        return Price(1/self.price, str(self.pair.swap()))
+        return Price(1/self.price, self.pair.swap())
 
     def express(self, pairstring):
         raise Unimplemented from ValueError
 
     def __mul__(self, other):  # multiplication by a scalar
-        return Price(float(other) * self.price, str(self.pair))
+        return Price(float(other) * self.price, self.pair)
     __rmul__=__mul__
 
     def __gt__(self, other):
@@ -118,6 +168,203 @@ class Price:
         return Price(price, parts[1])
 
 
+class PriceRange:
+    #
+    #  PriceRange(0, 0.50, 4000, "BTS:USD")           - same prices as Price.linspace()
+    #  PriceRange(0.01, 1, 201, "BTS:USD", "log")     - logarithmically spaced
+    #
+    # A lazy, read-only sequence of Prices.  Holds only its endpoints, count
+    # and pair (O(1) memory, whatever the count), and makes Price objects
+    # only as they are indexed or iterated.  Slices (e.g. P[1:]) are
+    # PriceRanges too.  .values() returns the prices as a float64 NumPy
+    # array, which the vectorized engines use directly.
+    #
+    __slots__ = ("start", "stop", "count", "pair", "spacing", "_offset", "_step", "_len")
+
+    def __init__(self, start, stop, count, pairstring, spacing="linear"):
+        if spacing not in ("linear", "log"):
+            raise ValueError("Unknown spacing: %s" % spacing)
+        if spacing == "log" and not (start > 0 and stop > 0):
+            raise ValueError("Log spacing needs positive endpoints")
+        if count < 0:
+            raise ValueError("Negative count")
+        self.start = start
+        self.stop = stop
+        self.count = count
+        self.pair = Pair(pairstring)
+        self.spacing = spacing
+        self._offset = 0    # (view onto indices _offset + _step*i of the full range)
+        self._step = 1
+        self._len = count
+
+    def _value(self, k):
+        # Price value at index k of the full range
+        n = self.count - 1
+        if n == 0:
+            return self.start
+        if self.spacing == "linear":
+            return self.start + (self.stop-self.start)*k/n
+        return self.start * (self.stop/self.start)**(k/n)
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self._len)
+            view = PriceRange(self.start, self.stop, self.count, self.pair, self.spacing)
+            view._offset = self._offset + start*self._step
+            view._step = self._step*step
+            view._len = len(range(start, stop, step))
+            return view
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError("PriceRange index out of range")
+        return Price(self._value(self._offset + i*self._step), self.pair)
+
+    def __iter__(self):
+        for i in range(self._len):
+            yield Price(self._value(self._offset + i*self._step), self.pair)
+
+    def __str__(self):
+        return "%s(%g .. %g, %d) %s" % (self.spacing, self.start, self.stop, self.count, self.pair)
+
+    def values(self):
+        # float64 ndarray of the price values (in units of .pair)
+        import numpy as np
+        k = self._offset + self._step*np.arange(self._len)
+        n = self.count - 1
+        if n == 0:
+            return np.full(self._len, self.start, dtype=float)
+        if self.spacing == "linear":
+            return self.start + (self.stop-self.start)*k/n
+        # (scalar pow, so that values agree exactly with indexing)
+        return np.fromiter((self._value(int(j)) for j in k), dtype=float, count=self._len)
+
+    def __array__(self, dtype=None, copy=None):
+        values = self.values()
+        return values if dtype is None else values.astype(dtype)
+
+
+class PriceEnvironment:
+    #
+    # A set of known prices, indexed by currency pair.  Accepted anywhere a
+    # plain list of known prices is (iterating yields the prices in order).
+    #
+    #   env = PriceEnvironment([Price(0.027, "BTS:USD"), Price(6, "CNY:BTS")])
+    #
+    #   env.find(pair)          -  First compatible price (either orientation), or None
+    #   env.price(pair)         -  Compatible price expressed in `pair` (inverse cached)
+    #   env.rate("CNY", "USD")  -  Units of USD per CNY: direct, inverse, or
+    #                              triangulated through the asset graph (memoized)
+    #
+    # As with a price list, the first compatible price for a pair wins.  Use
+    # [price] + env to get a new environment in which `price` takes precedence.
+    #
+    def __init__(self, prices=[]):
+        self.prices = []
+        self._index = {}     # (base, quote) -> first compatible Price
+        self._graph = {}     # symbol -> [neighbouring symbols]
+        self._flipped = {}   # (base, quote) -> Price expressed in (base, quote)
+        self._rates = {}     # (symbol, quote) -> rate, memoized
+        for p in prices:
+            self.add(p)
+
+    def add(self, price): # mutates
+        self.prices.append(price)
+        base, quote = price.pair.base, price.pair.quote
+        if (base, quote) not in self._index:
+            self._index[(base, quote)] = price
+            self._index[(quote, base)] = price
+            self._graph.setdefault(base, []).append(quote)
+            self._graph.setdefault(quote, []).append(base)
+            self._rates = {}  # new edges may shorten paths
+
+    def __iter__(self):
+        return iter(self.prices)
+
+    def __len__(self):
+        return len(self.prices)
+
+    def __add__(self, other):
+        return PriceEnvironment(self.prices + list(other))
+
+    def __radd__(self, other):
+        return PriceEnvironment(list(other) + self.prices)
+
+    def find(self, pair):
+        return self._index.get((pair.base, pair.quote))
+
+    def price(self, pair):
+        price = self.find(pair)
+        if price is None or price.pair.same(pair):
+            return price
+        key = (pair.base, pair.quote)
+        if key not in self._flipped:
+            self._flipped[key] = price.flip()
+        return self._flipped[key]
+
+    def rate(self, symbol, quote):
+        if symbol == quote:
+            return 1
+        key = (symbol, quote)
+        if key not in self._rates:
+            self._rates[key] = self._triangulate(symbol, quote)
+        return self._rates[key]
+
+    def _edgeRate(self, symbol, quote):
+        price = self._index[(symbol, quote)]
+        return price.price if price.pair.base == symbol else 1/price.price
+
+    def path(self, symbol, quote):
+        # Shortest list of symbols leading from `symbol` to `quote` through
+        # known prices, or None if there is none.
+        previous = {symbol: None}
+        frontier = [symbol]
+        while frontier and quote not in previous:
+            nextfrontier = []
+            for sym in frontier:
+                for nbr in self._graph.get(sym, []):
+                    if nbr not in previous:
+                        previous[nbr] = sym
+                        nextfrontier.append(nbr)
+            frontier = nextfrontier
+        if quote not in previous:
+            return None
+        path = [quote]
+        while previous[path[-1]] is not None:
+            path.append(previous[path[-1]])
+        return path[::-1]
+
+    def _triangulate(self, symbol, quote):
+        path = self.path(symbol, quote)
+        if path is None:
+            raise ValueError("No compatible price found in knownprices")
+        rate = self._edgeRate(path[0], path[1])
+        for a, b in zip(path[1:-1], path[2:]):
+            rate *= self._edgeRate(a, b)
+        return rate
+
+    @staticmethod
+    def wrap(knownprices):
+        # Returns `knownprices` as a PriceEnvironment (itself, if it is one)
+        if isinstance(knownprices, PriceEnvironment):
+            return knownprices
+        return PriceEnvironment(knownprices)
+
+    @staticmethod
+    def lookup(knownprices, pair):
+        # First price in `knownprices` (list or environment) compatible with
+        # `pair`, or None
+        if isinstance(knownprices, PriceEnvironment):
+            return knownprices.find(pair)
+        for price in knownprices:
+            if price.pair.compat(pair):
+                return price
+        return None
+
+
 class AssetBag:
     #
     # A numeric balance and an asset symbol.
@@ -130,7 +377,18 @@ class AssetBag:
     #   .absorb(other)     -  Increases bag by amount of other, if compatible
     #   .setAmount(amount) -  Sets amount
     #
+    # An optional `.label` (string) may be attached for plotting.
+    #
+    # Fixed-point mode (AssetBag.setFixedPoint()) makes all amount arithmetic
+    # (absorb, +, -, and Account deposits) work in integer units of
+    # 10**-precision, as on chain, using the precision table.  Amounts stay
+    # floats, but always hold exactly quantized values, so results do not
+    # depend on summation order.  Every symbol then needs a precision.
+    #
+    __slots__ = ("amount", "symbol", "label")
     precisions = {}   # Precision table, e.g. {"USD": 2, "CNY":, 2}
+    fixedpoint = False  # Integer-unit arithmetic (see setFixedPoint())
+    _validsymbols = set()   # Symbols already validated
     #
     def __init__(self, amount, symbol=None):
         if isinstance(amount, str):
@@ -143,7 +401,7 @@ class AssetBag:
 
     def absorb(self, other):    # mutates
         if self.symbol == other.symbol:
-            self.amount += other.amount
+            self.amount = AssetBag.addAmounts(self.symbol, self.amount, other.amount)
         else:
             raise ValueError("Incompatible Assets")
 
@@ -161,12 +419,24 @@ class AssetBag:
         # provided a compatible price is found in `knownprices`
         if self.symbol == quote:
             return AssetBag(self.amount, quote)
+        return AssetBag(self.amount * AssetBag.exchangeRate(self.symbol, quote, knownprices), quote)
+
+    @staticmethod
+    def exchangeRate(symbol, quote, knownprices):
+        # Units of 'quote' per unit of 'symbol', from the first compatible
+        # (direct or inverse) price found in `knownprices`, or else
+        # triangulated through other known prices (e.g. CNY -> BTS -> USD).
+        if symbol == quote:
+            return 1
+        if isinstance(knownprices, PriceEnvironment):
+            return knownprices.rate(symbol, quote)
         for price in knownprices:
             if price.pair.base == quote:
-                price = price.flip()
-            if price.pair.base == self.symbol and price.pair.quote == quote:
-                return AssetBag(self.amount * price.price, quote)
-        raise ValueError("No compatible price found in knownprices")
+                if price.pair.quote == symbol:
+                    return 1/price.price
+            elif price.pair.base == symbol and price.pair.quote == quote:
+                return price.price
+        return PriceEnvironment(knownprices).rate(symbol, quote)
 
     def __mul__(self, other):
         return AssetBag(float(other)*self.amount, self.symbol)
@@ -175,12 +445,12 @@ class AssetBag:
     def __add__(self, other):
         if not self.compatible(other):
             raise ValueError("Incompatible assets")
-        return AssetBag(self.amount + other.amount, self.symbol)
+        return AssetBag(AssetBag.addAmounts(self.symbol, self.amount, other.amount), self.symbol)
 
     def __sub__(self, other):
         if not self.compatible(other):
             raise ValueError("Incompatible assets")
-        return AssetBag(self.amount - other.amount, self.symbol)
+        return AssetBag(AssetBag.addAmounts(self.symbol, self.amount, -other.amount), self.symbol)
 
     def __str__(self):
         if self.symbol in AssetBag.precisions:
@@ -202,15 +472,42 @@ class AssetBag:
     def setPrecision(cls, symbol, prec):
         cls.precisions[symbol] = prec   # Set decimal precision of assets for printing, by symbol
 
+    @classmethod
+    def setFixedPoint(cls, enable=True):
+        cls.fixedpoint = enable         # Integer-unit arithmetic for all amounts
+
+    @staticmethod
+    def toUnits(amount, symbol):
+        # Amount as an integer number of 10**-precision units
+        if symbol not in AssetBag.precisions:
+            raise ValueError("No precision set for %s" % symbol)
+        return int(round(amount * 10**AssetBag.precisions[symbol]))
+
+    @staticmethod
+    def fromUnits(units, symbol):
+        if symbol not in AssetBag.precisions:
+            raise ValueError("No precision set for %s" % symbol)
+        return units / 10**AssetBag.precisions[symbol]
+
+    @staticmethod
+    def addAmounts(symbol, a, b):
+        # a + b, in integer units when in fixed-point mode
+        if AssetBag.fixedpoint:
+            return AssetBag.fromUnits(AssetBag.toUnits(a, symbol) + AssetBag.toUnits(b, symbol), symbol)
+        return a + b
+
     @staticmethod
     def validSymbol(symbol):
         if not isinstance(symbol, str):
             return False
+        if symbol in AssetBag._validsymbols:
+            return True
         if len(symbol) == 0:
             return False
         ok = "QWERTYUIOPASDFGHJKLZXCVBNM."
         if not all(c in ok for c in symbol):
             return False
+        AssetBag._validsymbols.add(symbol)
         return True
 
     @staticmethod
@@ -231,38 +528,68 @@ class AssetBag:
 
 class Account:
     #
-    # A list of AssetBags, essentially
+    # A collection of asset balances, kept as a mapping from symbol to amount
+    # (in the order in which symbols were first received).  The `.bags` view
+    # presents the balances as a list of AssetBags.
     #
     # Note that Contract objects may add baggage to the account in the form of
     # additional members.  These serve as metadata for studies and for plotting
     # and describing contracts.
     #
     def __init__(self):
-        self.bags = []
+        self.balances = {}  # symbol -> amount
+
+    @property
+    def bags(self):
+        return [AssetBag(amount, symbol) for symbol, amount in self.balances.items()]
+
+    @bags.setter
+    def bags(self, bags): # mutates
+        self.balances = {}
+        self.receiveMany(bags)
+
+    def deposit(self, symbol, amount): # mutates
+        balances = self.balances
+        if symbol in balances:
+            if AssetBag.fixedpoint:
+                balances[symbol] = AssetBag.addAmounts(symbol, balances[symbol], amount)
+            else:
+                balances[symbol] += amount
+        else:
+            AssetBag.assertSymbolValid(symbol)
+            balances[symbol] = AssetBag.addAmounts(symbol, 0, amount) if AssetBag.fixedpoint else amount
 
     def receive(self, rbag): # mutates
-        for bag in self.bags:
-            if bag.compatible(rbag):
-                bag.absorb(rbag)
-                break
-        else:
-            self.bags.append(rbag.clone())
+        self.deposit(rbag.symbol, rbag.amount)
+
+    def receiveMany(self, rbags): # mutates
+        for rbag in rbags:
+            self.deposit(rbag.symbol, rbag.amount)
+
+    def depositMany(self, amounts): # mutates
+        # amounts: mapping of symbol -> amount, or iterable of (symbol, amount)
+        if isinstance(amounts, dict):
+            amounts = amounts.items()
+        for symbol, amount in amounts:
+            self.deposit(symbol, amount)
+
+    def amount(self, symbol):
+        return self.balances.get(symbol, 0)
 
     def empty(self): # mutates
-        self.bags = []
+        self.balances = {}
 
     def valuation(self, quote, knownprices):
-        value = AssetBag(0, quote)
-        for bag in self.bags:
-            value.absorb(bag.valuation(quote, knownprices))
-        return value
+        value = 0
+        for symbol, amount in self.balances.items():
+            value += amount * AssetBag.exchangeRate(symbol, quote, knownprices)
+        return AssetBag(value, quote)
 
     def copy(self):
         # Returns a deep copy of the Account, stripping any additional baggage
         # added by, e.g., Contract objects.
-        retval  = Account()
-        for bag in self.bags:
-            retval.receive(bag.clone())
+        retval = Account()
+        retval.balances = dict(self.balances)
         return retval
 
     def prettyPrint(self, quote = None, knownprices = None):
@@ -275,6 +602,16 @@ class Account:
             print ("Total valuation: %s" % self.valuation(quote, knownprices))
 
 
+# Reveal tests of an observed price value v against threshold t, keyed by
+# (exceeds, strict).  Written as the Price comparisons they replace
+# (e.g. v >= t  is  not t > v).
+def _RevealGE(v, t): return not t > v
+def _RevealGT(v, t): return v > t
+def _RevealLE(v, t): return not v > t
+def _RevealLT(v, t): return t > v
+_RevealTests = {(True, False): _RevealGE, (True, True): _RevealGT,
+                (False, False): _RevealLE, (False, True): _RevealLT}
+
 class OracleHash:
     #
     #  Defines a threshold to reveal a preimage.
@@ -293,26 +630,69 @@ class OracleHash:
     #  Use the factory mathods (.GT(), .LT(), .GE(), .LE()) to simplify
     #  creation.
     #
+    #  The threshold value, its pair in both orientations, and the
+    #  comparison are resolved once at construction, so isRevealed() makes
+    #  no allocations: an inverted observation costs one float division
+    #  (1/x is compared against the threshold, exactly as the flipped Price
+    #  would be).  isRevealedMany() compares a whole array of raw values
+    #  (see also compareMany(), for arrays of thresholds).
+    #  The oracle is treated as immutable once built.
+    #
+    __slots__ = ("threshprice", "strict", "exceeds", "_value", "_pair", "_inverse", "_test")
+
     def __init__(self, threshprice, strict, exceeds):
         if isinstance(threshprice, str):
             threshprice = Price(threshprice)
         self.threshprice = threshprice
         self.strict = strict
         self.exceeds = exceeds
+        self._value = threshprice.price
+        self._pair = threshprice.pair
+        self._inverse = threshprice.pair.swap()
+        self._test = _RevealTests[(bool(exceeds), bool(strict))]
 
     def isRevealed(self, obsprice):
-        if not obsprice.pair.same(self.threshprice.pair):
-            obsprice = obsprice.flip()  # (tolerate compatible but inverted obs price)
-        if self.exceeds:
-            if self.strict:
-                return obsprice > self.threshprice
-            else:
-                return obsprice >= self.threshprice
-        else:
-            if self.strict:
-                return obsprice < self.threshprice
-            else:
-                return obsprice <= self.threshprice
+        pair = obsprice.pair
+        if pair is self._pair:
+            return self._test(obsprice.price, self._value)
+        if pair is self._inverse:   # (tolerate compatible but inverted obs price)
+            return self._test(1/obsprice.price, self._value)
+        if not pair.compat(self._pair):
+            raise ValueError("Incompatible prices")
+        v = obsprice.price if pair.same(self._pair) else 1/obsprice.price
+        return self._test(v, self._value)
+
+    def isRevealedMany(self, values, pair=None):
+        # Reveal state at each of an array of raw price values (in units of
+        # `pair`, by default the threshold pair) as a bool ndarray.
+        import numpy as np
+        values = np.asarray(values, dtype=float)
+        if pair is None:
+            pair = self._pair
+        elif isinstance(pair, str):
+            pair = Pair(pair)
+        if type(self) is not OracleHash:    # (subclasses: their own isRevealed())
+            return np.fromiter((self.isRevealed(Price(float(v), pair)) for v in values),
+                               dtype=bool, count=len(values))
+        if not pair.compat(self._pair):
+            raise ValueError("Incompatible prices")
+        if not pair.same(self._pair):
+            with np.errstate(divide='ignore'):
+                values = 1/values
+        return OracleHash.compareMany(values, self._value, self.strict, self.exceeds)
+
+    @staticmethod
+    def compareMany(values, thresh, strict, exceeds):
+        # Vectorized reveal test, with exactly the semantics of isRevealed():
+        # `values` and `thresh` are raw prices in the threshold pair, and
+        # broadcast against each other; `strict` and `exceeds` are bools or
+        # bool arrays shaped like `thresh`.  (The one array implementation
+        # behind isRevealedMany(), CompiledContract and Portfolio.)
+        import numpy as np
+        above = values > thresh
+        below = thresh > values
+        return np.where(exceeds, np.where(strict, above, ~below),
+                                 np.where(strict, below, ~above))
 
     def priceCompatible(self, price):
         return price.pair.compat(self.threshprice.pair)
@@ -357,6 +737,8 @@ class HashTranche:
     #                           based on reveal state of `ohash` determined by first
     #                           compatible price in `pricelist`
     #
+    __slots__ = ("ohash", "asset", "taccount", "haccount")
+
     def __init__(self, ohash, asset, taccount, haccount):
         if isinstance(asset, str):
             asset = AssetBag(asset)
@@ -366,6 +748,9 @@ class HashTranche:
         self.haccount = haccount
 
     def disburse(self, knownprices):  # mutates member objects
+        if isinstance(knownprices, PriceEnvironment):
+            price = knownprices.price(self.ohash.threshprice.pair)
+            knownprices = [] if price is None else [price]
         for price in knownprices:
             if self.ohash.priceCompatible(price):
                 if self.ohash.isRevealed(price):
@@ -379,6 +764,214 @@ class HashTranche:
     def __str__(self):
         return "%s \t%s"%(str(self.asset), str(self.ohash))
 
+class ThresholdIndex:
+    #
+    # Sorted index of the thresholds of a list of HashTranches, for settling
+    # many tranches at one price without visiting them one by one.
+    #
+    # Tranches are grouped by threshold pair and by oracle direction and
+    # strictness.  Within a group the revealed tranches always form either a
+    # prefix (exceeds) or a suffix (not exceeds) of the threshold-sorted
+    # list, so the split point is a single bisection.  For each
+    # (account, symbol) that a group can pay, prefix and suffix sums of the
+    # amounts (and of the tranche counts) turn the split point into totals.
+    #
+    # Tranches whose oracle is a user subclass of OracleHash cannot be
+    # indexed; they are kept in `.loose` and disbursed individually.
+    #
+    class _Group:
+        def __init__(self, pair, exceeds, strict, tranches):
+            tranches = sorted(tranches, key=lambda t: t.ohash.threshprice.price)
+            self.pair = pair
+            self.exceeds = exceeds
+            self.strict = strict
+            self.tranches = tranches
+            self.thresholds = [t.ohash.threshprice.price for t in tranches]
+            # sums[(id(account), symbol, hashside)] = [account, symbol, prefix, suffix]
+            self.sums = {}
+            n = len(tranches)
+            for t in tranches:
+                for acct, hashside in ((t.haccount, True), (t.taccount, False)):
+                    key = (id(acct), t.asset.symbol, hashside)
+                    if key not in self.sums:
+                        self.sums[key] = [acct, t.asset.symbol, None, None]
+            zero = 0 if AssetBag.fixedpoint else 0.0
+            for entry in self.sums.values():
+                entry[2] = [(zero, 0)]*(n+1)  # (amount, count) over tranches[:k]
+                entry[3] = [(zero, 0)]*(n+1)  # (amount, count) over tranches[k:]
+            for key, entry in self.sums.items():
+                acctid, symbol, hashside = key
+                prefix, suffix = entry[2], entry[3]
+                for i, t in enumerate(tranches):
+                    hit = (t.asset.symbol == symbol and
+                           id(t.haccount if hashside else t.taccount) == acctid)
+                    amt, cnt = prefix[i]
+                    prefix[i+1] = (amt + ThresholdIndex.amountOf(t), cnt + 1) if hit else (amt, cnt)
+                for i in range(n-1, -1, -1):
+                    t = tranches[i]
+                    hit = (t.asset.symbol == symbol and
+                           id(t.haccount if hashside else t.taccount) == acctid)
+                    amt, cnt = suffix[i+1]
+                    suffix[i] = (amt + ThresholdIndex.amountOf(t), cnt + 1) if hit else (amt, cnt)
+
+        def split(self, value):
+            # Index k such that tranches[:k] (exceeds) or tranches[k:]
+            # (not exceeds) are the revealed ones at observed `value`.
+            if self.exceeds:    # revealed when threshold <= value (GE) or < value (GT)
+                return (bisect.bisect_left if self.strict else bisect.bisect_right)(self.thresholds, value)
+            else:               # revealed when threshold >= value (LE) or > value (LT)
+                return (bisect.bisect_right if self.strict else bisect.bisect_left)(self.thresholds, value)
+
+    def __init__(self, tranches):
+        self.ntranches = len(tranches)
+        self.fixedpoint = AssetBag.fixedpoint   # (sums in integer units if so)
+        self.loose = []
+        members = {}
+        for t in tranches:
+            if type(t.ohash) is not OracleHash:
+                self.loose.append(t)
+                continue
+            pair = t.ohash.threshprice.pair
+            key = (pair.base, pair.quote, t.ohash.exceeds, t.ohash.strict)
+            members.setdefault(key, []).append(t)
+        self.groups = [ThresholdIndex._Group(m[0].ohash.threshprice.pair, key[2], key[3], m)
+                       for key, m in members.items()]
+
+    @staticmethod
+    def amountOf(tranche):
+        if AssetBag.fixedpoint:
+            return AssetBag.toUnits(tranche.asset.amount, tranche.asset.symbol)
+        return tranche.asset.amount
+
+    @staticmethod
+    def observe(group, knownprices):
+        # Observed price of the group's pair, in group pair units
+        price = PriceEnvironment.lookup(knownprices, group.pair)
+        if price is None:
+            raise ValueError("No compatible price in knownprices")
+        return price.price if price.pair.same(group.pair) else 1/price.price
+
+    def settle(self, knownprices):
+        # Returns a list of (account, symbol, amount, count) disbursements that
+        # the indexed tranches make at `knownprices`.  Does not mutate.
+        totals = {}
+        for g in self.groups:
+            k = g.split(ThresholdIndex.observe(g, knownprices))
+            for key, (acct, symbol, prefix, suffix) in g.sums.items():
+                hashsums, timeoutsums = (prefix, suffix) if g.exceeds else (suffix, prefix)
+                amt, cnt = (hashsums if key[2] else timeoutsums)[k]
+                if cnt > 0:
+                    tot = totals.setdefault((key[0], symbol), [acct, symbol, 0, 0])
+                    tot[2] += amt
+                    tot[3] += cnt
+        if self.fixedpoint:
+            return [(acct, symbol, AssetBag.fromUnits(amt, symbol), cnt)
+                    for acct, symbol, amt, cnt in totals.values()]
+        return [tuple(tot) for tot in totals.values()]
+
+    def disburse(self, knownprices):  # mutates accounts
+        for acct, symbol, amount, count in self.settle(knownprices):
+            acct.deposit(symbol, amount)
+        for t in self.loose:
+            t.disburse(knownprices)
+
+
+class IncrementalSettlement:
+    #
+    # Keeps the accounts of a contract settled at the latest observed price.
+    #
+    # The first update() concludes the contract from empty accounts and
+    # remembers, for every ThresholdIndex group, the split point between
+    # revealed and unrevealed tranches.  Each later update() bisects for the
+    # new split point and moves only the tranches between the old and new
+    # split points from `taccount` to `haccount` (or back), so the cost of a
+    # tick is O(groups * log n + tranches crossed).  Tranches with custom
+    # oracles (ThresholdIndex `.loose`) are re-checked on every tick.
+    #
+    # A per-(account, symbol) count of tranches held is kept so that a
+    # symbol is dropped from an account when its last tranche leaves, as if
+    # the account had been concluded afresh.  Totals agree with conclude()
+    # to within floating-point rounding.
+    #
+    def __init__(self, contract):
+        self.contract = contract
+        self.index = contract.getThresholdIndex()
+        self.ntranches = len(contract.tranches)
+        self.splits = None      # split point of each group at last update
+        self.loosestate = None  # reveal state of each loose tranche
+        self.counts = {}        # (id(account), symbol) -> tranches held
+        self.flipped = 0        # tranches moved by the last update
+
+    def _move(self, t, revealed):  # mutates accounts
+        src, dst = (t.taccount, t.haccount) if revealed else (t.haccount, t.taccount)
+        symbol, amount = t.asset.symbol, t.asset.amount
+        key = (id(src), symbol)
+        self.counts[key] -= 1
+        if self.counts[key]:
+            src.balances[symbol] = AssetBag.addAmounts(symbol, src.balances[symbol], -amount)
+        else:
+            del src.balances[symbol]
+        self._put(dst, symbol, amount)
+
+    def _put(self, acct, symbol, amount):  # mutates acct
+        key = (id(acct), symbol)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        acct.deposit(symbol, amount)
+
+    def _start(self, knownprices):  # mutates accounts
+        for acc in self.contract.accounts:
+            acc.empty()
+        self.counts = {}
+        self.splits = []
+        for g in self.index.groups:
+            k = g.split(ThresholdIndex.observe(g, knownprices))
+            self.splits.append(k)
+            for i, t in enumerate(g.tranches):
+                revealed = (i < k) if g.exceeds else (i >= k)
+                self._put(t.haccount if revealed else t.taccount, t.asset.symbol, t.asset.amount)
+        self.loosestate = []
+        for t in self.index.loose:
+            revealed = bool(t.ohash.isRevealed(self._loosePrice(t, knownprices)))
+            self.loosestate.append(revealed)
+            self._put(t.haccount if revealed else t.taccount, t.asset.symbol, t.asset.amount)
+        self.flipped = self.ntranches
+
+    @staticmethod
+    def _loosePrice(t, knownprices):
+        price = PriceEnvironment.lookup(knownprices, t.ohash.threshprice.pair)
+        if price is None:
+            raise ValueError("No compatible price in knownprices")
+        return price
+
+    def update(self, knownprices):  # mutates accounts
+        # Settle at knownprices (list of Prices or a PriceEnvironment).
+        # Returns the number of tranches that changed hands.
+        self.contract.pricelistcache = knownprices
+        if self.splits is None:
+            self._start(knownprices)
+            return self.flipped
+        flipped = 0
+        for gi, g in enumerate(self.index.groups):
+            k0 = self.splits[gi]
+            k = g.split(ThresholdIndex.observe(g, knownprices))
+            if k == k0:
+                continue
+            # exceeds: tranches[:k] revealed; else tranches[k:] revealed
+            revealed = (k > k0) if g.exceeds else (k < k0)
+            for t in g.tranches[min(k, k0):max(k, k0)]:
+                self._move(t, revealed)
+            flipped += abs(k - k0)
+            self.splits[gi] = k
+        for i, t in enumerate(self.index.loose):
+            revealed = bool(t.ohash.isRevealed(self._loosePrice(t, knownprices)))
+            if revealed != self.loosestate[i]:
+                self._move(t, revealed)
+                self.loosestate[i] = revealed
+                flipped += 1
+        self.flipped = flipped
+        return flipped
+
+
 class Contract:
     #
     # Basically a list of HashTranches and a list of destination accounts.
@@ -387,25 +980,93 @@ class Contract:
         self.tranches = []
         self.accounts = []
         self.pricelistcache = [] # set by .conclude()
+        self.thresholdindex = None # built by .getThresholdIndex()
+        self.incremental = None # kept by .settle()
+        self.revision = 0 # bumped by .changed()
 
     def reset(self): # mutates
+        self.incremental = None
         for acc in self.accounts:   # Empties (but does not
             acc.empty()             # remove) all accounts
 
+    def changed(self): # mutates
+        # Drops state derived from the tranche table (threshold index,
+        # incremental settlement) and bumps .revision, which compiled forms
+        # elsewhere (e.g. Portfolio) check.  The mutating methods call this;
+        # call it after editing .tranches, or a tranche, directly.
+        self.thresholdindex = None
+        self.incremental = None
+        self.revision += 1
+
     def addNAccounts(self, n): # mutates
         for _ in range(n):
             self.accounts.append(Account())
+        self.changed()
 
     def addTranche(self, ohash, asset, tindex=0, hindex=1): # mutates
         self.tranches.append(
             HashTranche(ohash, asset, taccount=self.accounts[tindex], haccount=self.accounts[hindex])
         )
-
-    def conclude(self, finalprices): # mutates
+        self.changed()
+
+    def optimize(self): # mutates
+        # Merges tranches that pay the same asset on the same oracle condition
+        # between the same two accounts into a single tranche, and drops
+        # tranches with zero amounts.  Merged tranches keep the place of the
+        # first of them, so accounts receive symbols in the same order.
+        # Returns the number of tranches removed.
+        merged = {}
+        tranches = []
+        for t in self.tranches:
+            if t.asset.amount == 0:
+                continue
+            oh = t.ohash
+            cond = ((oh.threshprice.pair, oh.threshprice.price, oh.strict, oh.exceeds)
+                    if type(oh) is OracleHash else id(oh))
+            key = (cond, id(t.taccount), id(t.haccount), t.asset.symbol)
+            if key in merged:
+                first = merged[key]
+                first.asset = AssetBag(AssetBag.addAmounts(t.asset.symbol, first.asset.amount,
+                                                           t.asset.amount), t.asset.symbol)
+            else:
+                merged[key] = HashTranche(oh, AssetBag(t.asset.amount, t.asset.symbol),
+                                          t.taccount, t.haccount)
+                tranches.append(merged[key])
+        tranches = [t for t in tranches if t.asset.amount != 0]
+        removed = len(self.tranches) - len(tranches)
+        self.tranches = tranches
+        self.changed()
+        return removed
+
+    def getThresholdIndex(self):
+        # Sorted index of tranche thresholds, (re)built after .changed()
+        if self.thresholdindex is None or self.thresholdindex.fixedpoint != AssetBag.fixedpoint:
+            self.thresholdindex = ThresholdIndex(self.tranches)
+        return self.thresholdindex
+
+    def conclude(self, finalprices, indexed=False): # mutates
+        # finalprices: list of Prices, or a PriceEnvironment
+        # indexed: settle through the sorted ThresholdIndex (a bisection per
+        #          tranche group) instead of disbursing tranche by tranche.
+        #          Totals agree to within floating-point rounding; each account
+        #          receives one bag per symbol.
         self.pricelistcache = finalprices
+        self.incremental = None
+        if indexed:
+            self.getThresholdIndex().disburse(finalprices)
+            return
         for t in self.tranches:
             t.disburse(finalprices)
 
+    def settle(self, finalprices): # mutates
+        # Incremental conclude() for a stream of prices: the first call
+        # concludes from empty accounts, later calls move only the tranches
+        # whose thresholds were crossed since the previous call.  Returns the
+        # number of tranches moved.  (See IncrementalSettlement)
+        if self.incremental is None:
+            self.incremental = IncrementalSettlement(self)
+        return self.incremental.update(finalprices)
+
     def doStudy_deprecated(self, varprices, quote, fixedprices = []): # mutates
         # varprices: list of prices spanning a range (becomes X values)
         # fixedprices: additional external price data (parameters other than X), if any
@@ -419,30 +1080,106 @@ class Contract:
                 YY[i].append(self.accounts[i].valuation(quote, self.pricelistcache))
         return YY
 
-    def doStudy(self, varprices, fixedprices = []): # mutates
+    def compile(self, fixedpoint=None):
+        # Returns a CompiledContract: the tranche table flattened into NumPy
+        # arrays for vectorized settlement.  fixedpoint: settle in int64
+        # units (default: AssetBag.fixedpoint).  (See CompiledContract.py)
+        from CompiledContract import CompiledContract
+        return CompiledContract(self, fixedpoint)
+
+    def payoff(self, pair, fixedprices = []):
+        # Returns a PayoffFunction: the exact piecewise-constant payoff of the
+        # contract against the price of `pair`.  (See PayoffFunction.py)
+        from PayoffFunction import PayoffFunction
+        return PayoffFunction(self, pair, fixedprices)
+
+    def template(self, notional=None):
+        # Returns a ContractTemplate: an immutable copy of this contract's
+        # schedule, from which scaled instances can be issued and studied
+        # without duplicating tranches.  (See ContractTemplate.py)
+        from ContractTemplate import ContractTemplate
+        return ContractTemplate(self, notional)
+
+    def gridStudy(self, axes, fixedprices = [], workers=None):
+        # N-dimensional study: settles the contract over the Cartesian grid of
+        # `axes` (one price sequence per pair).  Returns a GridStudy holding a
+        # dense ndarray of balances indexed by grid coordinates.  (Requires
+        # NumPy; see GridStudy.py)
+        from GridStudy import GridStudy
+        return GridStudy(self, axes, fixedprices).run(workers)
+
+    def sensitivities(self, spots, volatility, horizon=1.0, quote=None, fixedprices=[], pair=None, drift=0.0):
+        # Closed-form expected value, delta, gamma and vega of every account
+        # under a lognormal closing price, batched over `spots`.  Returns a
+        # dict of ndarrays shaped (accounts, len(spots)).  `quote` defaults
+        # to the quote asset of the underlying pair.  (See LognormalPricer.py;
+        # use SensitivityBook there for many contracts at once.)
+        from LognormalPricer import LognormalPricer
+        if pair is None and getattr(self, "openingbaseprice", None) is None:
+            raise ValueError("No underlying pair given or found in contract")
+        if pair is None and quote is None:
+            quote = self.openingbaseprice.pair.quote
+        if quote is None:
+            quote = Pair(pair).quote
+        return LognormalPricer(self, quote, fixedprices, pair).sensitivities(spots, volatility, horizon, drift)
+
+    def doStudy(self, varprices, fixedprices = [], engine="default"): # mutates
         # For each account in contract:
-        #   Make a list of account copies "concluded" at each price in varprices
+        #   Record the account balances "concluded" at each price in varprices
         #
         # varprices: list of prices spanning a range (becomes X values)
-        # fixedprices: additional external price data (parameters other than X), if any
+        # fixedprices: additional external price data (parameters other than X), if any,
+        #              as a list of Prices or a PriceEnvironment
+        # engine: "default" concludes the contract once per price point;
+        #         "compiled" settles all price points in one vectorized pass
+        #         (requires NumPy).  Both produce the same results.
+        #         "breakpoints" evaluates the exact step payoff (see .payoff())
+        #         by bisection at each price point.
         #
         # Creates following new structure in Contract object, which can be interpreted
         # by the plotting subsystem:
         #
         #   (Contract).StudyX = [a Price series]
         #   (Contract).StudyPriceEnv
-        #   (Contract).accounts[...].StudyResults = [ series of Account copies ]
+        #   (Contract).Study = StudyStore (columnar balances; see StudyStore.py)
+        #   (Contract).accounts[...].StudyResults = [ series of Account views ]
         #
-        for ac in self.accounts:
-            ac.StudyResults = []
-        for pr in varprices:
-            self.reset()
-            self.conclude([pr]+fixedprices)
-            for ac in self.accounts:
-                ac.StudyResults.append(ac.copy())
+        from StudyStore import StudyStore
+        if engine in ["compiled"]:
+            store = self.compile().study(varprices, fixedprices)
+        elif engine in ["breakpoints"]:
+            if not isinstance(varprices, PriceRange):
+                varprices = list(varprices)
+            store = self.payoff(varprices[0].pair, fixedprices).study(varprices) if varprices else \
+                    self.compile().study(varprices, fixedprices)
+        elif engine in ["default"]:
+            varprices = list(varprices)
+            symbols = []
+            for t in self.tranches:
+                if t.asset.symbol not in symbols:
+                    symbols.append(t.asset.symbol)
+            store = StudyStore.empty(varprices[0].pair if varprices else None,
+                                     [pr.price for pr in varprices], len(self.accounts), symbols)
+            for k, pr in enumerate(varprices):
+                self.reset()
+                self.conclude([pr]+fixedprices)
+                store.record(k, self.accounts)
+        else:
+            raise ValueError("Unknown study engine: %s" % engine)
+        for a, ac in enumerate(self.accounts):
+            ac.StudyResults = store.results(a)
+        self.Study = store
         self.StudyX = varprices
         self.StudyPriceEnv = fixedprices
 
+    def iterStudy(self, varprices, fixedprices = [], chunksize=4096):
+        # Lazy version of .doStudy(): yields StudyStore chunks of at most
+        # `chunksize` points, each with .start (offset into the sweep) and
+        # .records() yielding (price, per-account balances).  `varprices` may
+        # be any iterable, including a generator.  Does not mutate the
+        # contract.  (Requires NumPy; see CompiledContract.py)
+        return self.compile().iterStudy(varprices, fixedprices, chunksize)
+
     def printTrancheTable(self):
         print ("TrancheTable contains %d slices." % len(self.tranches))
         for tr in self.tranches:
@@ -487,6 +1224,16 @@ def _Test_Account():
     ac.prettyPrint("BTS", [Price(0.027, "BTS:USD"), Price(6, "CNY:BTS")])
 
 
+def _Test_PriceEnvironment():
+    print ("\nPriceEnvironment Test:\n")
+    env = PriceEnvironment([Price(0.027, "BTS:USD"), Price(6, "CNY:BTS")])
+    ac = Account()
+    ac.receive(AssetBag(10, "BTS"))
+    ac.receive(AssetBag(10, "CNY"))
+    print("CNY -> USD via %s: %g" % (" -> ".join(env.path("CNY", "USD")), env.rate("CNY", "USD")))
+    ac.prettyPrint("USD", env)
+
+
 def _Test_HashTranche():
     print ("\nHashTranche Test:\n")
     A = Account()
@@ -525,10 +1272,124 @@ def _Test_Contract():
         C.printAccountValuesLine("BTS", firstcoltext=str(price))
     print()
 
+def _Test_ThresholdIndex():
+    print("\nThresholdIndex Test\n")
+    C = Contract()
+    C.addNAccounts(2)
+    for p in [12, 11, 10, 9, 8]:
+        C.addTranche(OracleHash.GT(Price(p, "USD:BTS")), "100 BTS")
+        C.addTranche(OracleHash.LE(Price(p, "USD:BTS")), "10 USD", 1, 0)
+    for p in [13, 12, 11, 10, 9, 8, 7]:
+        price = Price(p, "USD:BTS")
+        C.reset()
+        C.conclude([price])
+        looped = [ac.valuation("BTS", [price]).amount for ac in C.accounts]
+        C.reset()
+        C.conclude([price], indexed=True)
+        indexed = [ac.valuation("BTS", [price]).amount for ac in C.accounts]
+        print("%s: %s" % (price, "agree" if looped == indexed else "DISAGREE"))
+
+
+def _Test_Optimize():
+    print("\nContract.optimize() Test\n")
+    C = Contract()
+    C.addNAccounts(2)
+    for p in [12, 11, 10, 9, 8]:
+        C.addTranche(OracleHash.GE(Price(p, "USD:BTS")), "60 BTS")
+        C.addTranche(OracleHash.GE(Price(p, "USD:BTS")), "40 BTS")
+        C.addTranche(OracleHash.GE(Price(p, "USD:BTS")), "10 USD", 1, 0)
+        C.addTranche(OracleHash.LT(Price(p, "USD:BTS")), "0 BTS")
+    before = []
+    for p in [13, 10, 7]:
+        C.reset()
+        C.conclude([Price(p, "USD:BTS")])
+        before.append([dict(ac.balances) for ac in C.accounts])
+    n = len(C.tranches)
+    removed = C.optimize()
+    print("Removed %d of %d tranches" % (removed, n))
+    for p, b in zip([13, 10, 7], before):
+        C.reset()
+        C.conclude([Price(p, "USD:BTS")])
+        after = [dict(ac.balances) for ac in C.accounts]
+        nonzero = [{s: a for s, a in bal.items() if a} for bal in b]
+        print("%s: %s" % (Price(p, "USD:BTS"), "agree" if after == nonzero else "DISAGREE"))
+
+def _Test_FixedPoint():
+    print("\nFixed-Point Test\n")
+    saved = dict(AssetBag.precisions)
+    AssetBag.setPrecision("BTS", 5)
+    AssetBag.setPrecision("USD", 4)
+    C = Contract()
+    C.addNAccounts(2)
+    for i in range(1000):
+        C.addTranche(OracleHash.GE(Price(10 + i/1000, "USD:BTS")), AssetBag(0.1 + i/3e3, "BTS"))
+        C.addTranche(OracleHash.LT(Price(10 + i/1000, "USD:BTS")), AssetBag(0.01, "USD"), 1, 0)
+    price = [Price(10.5, "USD:BTS")]
+    results = {}
+    for fixed in [False, True]:
+        AssetBag.setFixedPoint(fixed)
+        for order in ["forward", "reversed"]:
+            C.reset()
+            for t in (C.tranches if order == "forward" else reversed(C.tranches)):
+                t.disburse(price)
+            results[(fixed, order)] = [dict(ac.balances) for ac in C.accounts]
+        C.reset()
+        C.conclude(price, indexed=True)
+        results[(fixed, "indexed")] = [dict(ac.balances) for ac in C.accounts]
+        C.optimize()
+        C.reset()
+        C.conclude(price)
+        results[(fixed, "optimized")] = [dict(ac.balances) for ac in C.accounts]
+    AssetBag.setFixedPoint(False)
+    AssetBag.precisions.clear()
+    AssetBag.precisions.update(saved)
+    for fixed in [False, True]:
+        same = all(results[(fixed, o)] == results[(fixed, "forward")]
+                   for o in ["reversed", "indexed", "optimized"])
+        print("%s: %s" % ("Fixed-point" if fixed else "Float", "order-independent" if same else "order-dependent"))
+    print("Fixed-point balances: %s" % results[(True, "forward")])
+
+def _Test_RevealMany():
+    print ("\nisRevealedMany Test:\n")
+    import numpy as np
+    values = np.array([0.05, 0.1, 0.1000000000000001, 0.2, 10.0, 1/0.1, 20.0, np.inf])
+    for make in [OracleHash.GE, OracleHash.GT, OracleHash.LE, OracleHash.LT]:
+        for thresh in ["0.1 BTS:USD", "10 USD:BTS"]:
+            oh = make(thresh)
+            for pair in ["BTS:USD", "USD:BTS"]:
+                scalar = [oh.isRevealed(Price(float(v), pair)) for v in values]
+                many = list(oh.isRevealedMany(values, pair))
+                print("%-36s obs %s: agree %s" % (oh, pair, scalar == many))
+
+
+def _Test_IncrementalSettlement():
+    print("\nIncrementalSettlement Test\n")
+    C = Contract()
+    C.addNAccounts(2)
+    for p in [12, 11, 10, 9, 8]:
+        C.addTranche(OracleHash.GT(Price(p, "USD:BTS")), "100 BTS")
+        C.addTranche(OracleHash.LE(Price(0.1*p, "BTS:CNY")), "10 USD", 1, 0)
+    ticks = [Price(p, "USD:BTS") for p in [10.5, 10.6, 11.5, 7, 13, 13, 9]]
+    for price in ticks:
+        known = [price, Price(2*price.price, "CNY:BTS")]
+        moved = C.settle(known)
+        streamed = [dict(ac.balances) for ac in C.accounts]
+        C.reset()
+        C.conclude(known)
+        concluded = [dict(ac.balances) for ac in C.accounts]
+        C.settle(known)  # (fresh start after conclude)
+        print("%s: moved %2d, %s" % (price, moved, "agree" if streamed == concluded else "DISAGREE"))
+
 
 if __name__ == '__main__':
 
     _Test_HashOracle()
     _Test_Account()
+    _Test_PriceEnvironment()
     _Test_HashTranche()
     _Test_Contract()
+    _Test_ThresholdIndex()
+    _Test_RevealMany()
+    _Test_IncrementalSettlement()
+    _Test_Optimize()
+    _Test_FixedPoint()
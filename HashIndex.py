@@ -0,0 +1,266 @@
+# HashIndex.py
+#
+# Reverse index from published hashes to the tables they came from.
+#
+# When a preimage turns up on chain, we want to know right away which
+# table (date, pair, predicate, plane, flip) and which price level it
+# reveals, without rebuilding every HashTable.  The index is two files:
+#
+#   <path>          -  Sorted fixed-width records, memory-mapped for lookup:
+#                        24-byte header: magic, keysize, ntables, nrecords
+#                        records: hash (keysize bytes), table id (u32),
+#                                 ladder index (u32), all big-endian
+#   <path>.json     -  Table registry: table id -> header, date, pair,
+#                      plane, flip, merkleroot, prices, ...
+#
+# Records sort as raw bytes, so a lookup is a binary search over the
+# mmap.  Adding tables merges the (few) new records into the (many) old
+# ones by copying the runs in between (or, for big batches, by a linear
+# merge), then atomically replaces the file.
+# The record file is the commit point: registry entries beyond its
+# ntables are ignored.
+#
+# Usage:
+#
+#   IX = HashIndex("hashindex.bin")
+#   IX.addTables(HT_list, source="200110_BTS-USD_Down.md")
+#   IX.findPreimage(preimage)    # -> [{"header":..., "index": 17, "price": 0.0215, ...}]
+#
+#.
+import argparse
+import bisect
+import hashlib
+import heapq
+import itertools
+import json
+import mmap
+import os
+import struct
+
+_Magic = b"HLIDX001"
+_Header = struct.Struct(">8sIIQ")       # magic, keysize, ntables, nrecords
+_Ref = struct.Struct(">II")             # table id, ladder index
+
+
+class _Records:
+    # Read-only sequence view of the records of a mapped index file, for
+    # bisect.  With `keysize` set, items are keys only.
+    def __init__(self, buf, count, recsize, keysize=None):
+        self.buf = buf
+        self.count = count
+        self.recsize = recsize
+        self.width = keysize if keysize is not None else recsize
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        a = _Header.size + i*self.recsize
+        return self.buf[a:a+self.width]
+
+
+class HashIndex:
+
+    def __init__(self, path, keysize=32):
+        self.path = path
+        self.keysize = keysize
+        self.tables = []
+        self.count = 0
+        self._file = None
+        self._map = None
+        self.open()
+
+    @property
+    def recsize(self):
+        return self.keysize + _Ref.size
+
+    def open(self):
+        # (Re)map the record file and load the registry
+        self.close()
+        if not os.path.exists(self.path):
+            self.tables = []
+            self.count = 0
+            return
+        self._file = open(self.path, "rb")
+        head = self._file.read(_Header.size)
+        if len(head) < _Header.size:
+            raise ValueError("Truncated hash index '%s'" % self.path)
+        magic, keysize, ntables, count = _Header.unpack(head)
+        if magic != _Magic:
+            raise ValueError("Not a hash index: '%s'" % self.path)
+        if os.fstat(self._file.fileno()).st_size != _Header.size + count*(keysize + _Ref.size):
+            raise ValueError("Hash index '%s' has wrong length" % self.path)
+        self.keysize = keysize
+        self.count = count
+        if count > 0:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        tables = []
+        if ntables > 0:
+            with open(self.path + ".json") as f:
+                tables = json.load(f)
+            if len(tables) < ntables:
+                raise ValueError("Hash index registry '%s.json' is missing tables" % self.path)
+        self.tables = tables[:ntables]
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __len__(self):
+        return self.count
+
+    ####
+    ## Building:
+
+    @staticmethod
+    def TableInfo(HT, source=None):
+        # Registry entry for a HashTable
+        info = {"header": HT.header,
+                "date": HT.date.strftime("%y%m%d"),
+                "pair": str(HT.pair),
+                "predicate": HT.predicate,
+                "plane": HT.PriceItr.plane,
+                "flip": HT.PriceItr.flip,
+                "merkleroot": HT.merkleroot.hex(),
+                "prices": [float(p) for p in HT.prices]}
+        if source is not None:
+            info["source"] = source
+        return info
+
+    def addTables(self, HT_list, source=None): # mutates
+        # Index the hashes of some HashTables.  Returns their table ids.
+        return self.add([(HashIndex.TableInfo(HT, source), HT.ladder.hashes) for HT in HT_list])
+
+    def addTable(self, HT, source=None): # mutates
+        return self.addTables([HT], source)[0]
+
+    def add(self, entries): # mutates
+        # Index (info, hashes) pairs, where info is a registry dict with at
+        # least "header" and "merkleroot".  Tables already indexed (same
+        # header and merkle root) are not added twice.  Returns table ids.
+        known = {(t["header"], t["merkleroot"]): i for i, t in enumerate(self.tables)}
+        tables = list(self.tables)
+        ids = []
+        new = []
+        for info, hashes in entries:
+            key = (info["header"], info["merkleroot"])
+            if key in known:
+                ids.append(known[key])
+                continue
+            tid = known[key] = len(tables)
+            tables.append(dict(info, count=len(hashes)))
+            ids.append(tid)
+            for i, h in enumerate(hashes):
+                if len(h) != self.keysize:
+                    raise ValueError("Index holds %d-byte hashes, got %d bytes" % (self.keysize, len(h)))
+                new.append(bytes(h) + _Ref.pack(tid, i))
+        if len(tables) > len(self.tables):
+            new.sort()
+            self._commit(tables, new)
+        return ids
+
+    def _commit(self, tables, new):
+        # Write registry, then merged record file; replacing the record file
+        # is what makes the new tables visible.
+        tmp = self.path + ".json.tmp"
+        with open(tmp, "w") as f:
+            json.dump(tables, f)
+        os.replace(tmp, self.path + ".json")
+
+        old = _Records(self._map, self.count, self.recsize)
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(_Header.pack(_Magic, self.keysize, len(tables), self.count + len(new)))
+            if len(new) * self.count.bit_length() > self.count:
+                # Many new records: a linear merge beats a search per record
+                merged = heapq.merge(self._iterRecords(), new)
+                while True:
+                    chunk = b"".join(itertools.islice(merged, 65536))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+            else:
+                pos = 0
+                run = []                # new records going in at `pos`
+                for rec in new:
+                    nxt = bisect.bisect_left(old, rec, pos)
+                    if nxt > pos:
+                        f.write(b"".join(run))
+                        run = []
+                        f.write(self._map[_Header.size + pos*self.recsize:_Header.size + nxt*self.recsize])
+                        pos = nxt
+                    run.append(rec)
+                f.write(b"".join(run))
+                if self.count > pos:
+                    f.write(self._map[_Header.size + pos*self.recsize:_Header.size + self.count*self.recsize])
+            f.flush()
+            os.fsync(f.fileno())
+        self.close()
+        os.replace(tmp, self.path)
+        self.open()
+
+    def _iterRecords(self, chunksize=65536):
+        R = self.recsize
+        for start in range(0, self.count, chunksize):
+            stop = min(start + chunksize, self.count)
+            block = self._map[_Header.size + start*R:_Header.size + stop*R]
+            yield from (block[k:k+R] for k in range(0, len(block), R))
+
+    ####
+    ## Lookup:
+
+    def lookup(self, hashbytes):
+        # List of (table id, ladder index) for a hash; empty if unknown.
+        if self.count == 0 or len(hashbytes) != self.keysize:
+            return []
+        keys = _Records(self._map, self.count, self.recsize, self.keysize)
+        i = bisect.bisect_left(keys, hashbytes)
+        found = []
+        while i < self.count and keys[i] == hashbytes:
+            a = _Header.size + i*self.recsize + self.keysize
+            found.append(_Ref.unpack(self._map[a:a+_Ref.size]))
+            i += 1
+        return found
+
+    def find(self, hashbytes):
+        # List of registry dicts (less prices) with "index" and "price" of
+        # each table level the hash belongs to.
+        found = []
+        for tid, index in self.lookup(hashbytes):
+            table = self.tables[tid]
+            entry = {k: v for k, v in table.items() if k != "prices"}
+            entry.update(table=tid, index=index, price=table["prices"][index])
+            found.append(entry)
+        return found
+
+    def findPreimage(self, preimage, hash_function=hashlib.sha256):
+        return self.find(hash_function(preimage).digest())
+
+    def table(self, tid):
+        return self.tables[tid]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Hash Index Tool: Find the table and price level of a hash or preimage.")
+    parser.add_argument('index', metavar="INDEX", help="Index file (as written by BuildHashTable.py --index)")
+    parser.add_argument('hashes', metavar="HEX", nargs='*', help="Hashes (or preimages) in hex")
+    parser.add_argument('--preimage', action='store_true', help="Arguments are preimages, not hashes")
+    args = parser.parse_intermixed_args()
+
+    IX = HashIndex(args.index)
+    print("((( Index '%s': %d hashes in %d tables" % (args.index, len(IX), len(IX.tables)))
+    for arg in args.hashes:
+        blob = bytes.fromhex(arg)
+        found = IX.findPreimage(blob) if args.preimage else IX.find(blob)
+        if not found:
+            print("%s  not found" % arg)
+        for f in found:
+            print("%s  %s  plane %s%s  level %d  price %g  (%s)" % (
+                arg, f["header"], f["plane"], " flip" if f["flip"] else "", f["index"], f["price"],
+                f.get("source", "table %d" % f["table"])))
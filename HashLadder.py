@@ -8,6 +8,7 @@
 # hash to a particular price point, market, and date target, and also
 # includes output mechanisms to print the tables.
 #
+import collections
 import configparser
 import datetime
 import hashlib
@@ -46,9 +47,23 @@ class HashLadder:
     #                                              v
     # [hash] <-- [preimage] <-- [pretext] <-- [ladderhash]
     #                                             ...
+    #
+    # Checkpointed (lazy) mode:  HashLadder(..., checkpoint=k) keeps only
+    # every k-th kernel, extending the chain as far as it is needed, and
+    # rebuilds any level's pretext, preimage and hash on demand from the
+    # closest checkpoint at or below it (at most k-1 hashes of the chain,
+    # plus two).  Recently used levels are kept in a small LRU.  In this
+    # mode .pretexts, .preimages and .hashes are read-only sequence views
+    # (indexable, sliceable, iterable) that produce exactly the same bytes
+    # as the eager lists.
+    #
+    # A ladder can also be rebuilt without hashing from stored kernels,
+    # preimages and hashes (see fromLevels() and LadderCache.py).
+    #
     def __init__(self,
                  header, rootHash, numHashes = 24,
-                 hash_function=hashlib.sha256
+                 hash_function=hashlib.sha256,
+                 checkpoint=None, cachesize=256
                 ):
 
         self.hash_function = hash_function
@@ -58,24 +73,109 @@ class HashLadder:
             raise ValueError
         if not numHashes > 0:
             raise ValueError
+        if checkpoint is not None and not checkpoint > 0:
+            raise ValueError
+
+        self.header = header
+        self.numhashes = numHashes
+        self.checkpoint = checkpoint
+
+        if checkpoint is not None:
+            self.checkpoints = [ self.BytesHash(rootHash) ]  # kernels 0, k, 2k, ...
+            self.cachesize = cachesize
+            self._cache = collections.OrderedDict()     # level -> (pretext, preimage, hash)
+            self.pretexts = _LadderLevels(self, 0)
+            self.preimages = _LadderLevels(self, 1)
+            self.hashes = _LadderLevels(self, 2)
+            return
 
         ladder = []
         ladder.append( self.BytesHash(rootHash) ) # first,
         for i in range(1, numHashes):             # ...and the rest.
             ladder.append( self.BytesHash(ladder[-1]) )
+        self.kernels = ladder
 
         # Get pretexts:
         self.pretexts = []   # strings
         self.preimages = []  # byte blobs
         self.hashes = []     # byte blobs
         for i in range(len(ladder)):
-            new_pretext = "%s:i%d:%s"%(header, i, ladder[i].hex())
-            new_preimage = self.StringHash(new_pretext)
-            new_hash = self.BytesHash(new_preimage)
+            new_pretext, new_preimage, new_hash = self.makeLevel(i, ladder[i])
             self.pretexts.append(new_pretext)
             self.preimages.append(new_preimage)
             self.hashes.append(new_hash)
 
+    @classmethod
+    def fromLevels(cls, header, kernels, preimages, hashes, hash_function=hashlib.sha256):
+        # Eager ladder from already-computed kernels, preimages and hashes
+        # (trusted as given; only the pretexts are rebuilt)
+        if not len(kernels) == len(preimages) == len(hashes) > 0:
+            raise ValueError
+        self = cls.__new__(cls)
+        self.hash_function = hash_function
+        self.header = header
+        self.numhashes = len(kernels)
+        self.checkpoint = None
+        self.kernels = list(kernels)
+        self.pretexts = ["%s:i%d:%s"%(header, i, kernel.hex()) for i, kernel in enumerate(kernels)]
+        self.preimages = list(preimages)
+        self.hashes = list(hashes)
+        return self
+
+    def iterKernels(self):
+        # Yields the kernel of every level, in order
+        if self.checkpoint is None:
+            yield from self.kernels
+            return
+        kernel = self.checkpoints[0]
+        for i in range(self.numhashes):
+            yield kernel
+            kernel = self.BytesHash(kernel)
+
+    def makeLevel(self, i, kernel):
+        # (pretext, preimage, hash) of level i, given its kernel
+        pretext = "%s:i%d:%s"%(self.header, i, kernel.hex())
+        preimage = self.StringHash(pretext)
+        return pretext, preimage, self.BytesHash(preimage)
+
+    ####
+    ## Checkpointed mode:
+    def getKernel(self, i):
+        # Kernel of level i, from the closest checkpoint (extending the
+        # checkpoint list first if the chain has not reached level i yet)
+        k = self.checkpoint
+        while len(self.checkpoints) <= i // k:
+            kernel = self.checkpoints[-1]
+            for _ in range(k):
+                kernel = self.BytesHash(kernel)
+            self.checkpoints.append(kernel)
+        kernel = self.checkpoints[i // k]
+        for _ in range(i % k):
+            kernel = self.BytesHash(kernel)
+        return kernel
+
+    def getLevel(self, i):
+        # (pretext, preimage, hash) of level i, via the LRU
+        level = self._cache.get(i)
+        if level is not None:
+            self._cache.move_to_end(i)
+            return level
+        level = self.makeLevel(i, self.getKernel(i))
+        self._cache[i] = level
+        if len(self._cache) > self.cachesize:
+            self._cache.popitem(last=False)
+        return level
+
+    def iterLevels(self, start=0):
+        # Yields (pretext, preimage, hash) of levels start, start+1, ...,
+        # walking the chain forward (one kernel hash per level)
+        k = self.checkpoint
+        kernel = self.getKernel(start) if start < self.numhashes else None
+        for i in range(start, self.numhashes):
+            yield self.makeLevel(i, kernel)
+            kernel = self.BytesHash(kernel)
+            if (i+1) % k == 0 and len(self.checkpoints) == (i+1) // k:
+                self.checkpoints.append(kernel)
 
     ####
     ## HASH Helpers:
@@ -86,8 +186,12 @@ class HashLadder:
         # String in, bytes blob out
         return self.BytesHash(msgstring.encode('utf-8'))
 
+    def getMerkleTree(self):
+        # Full tree, for inclusion proofs of individual hashes
+        return MerkleTree(self.hashes, self.hash_function)
+
     def getMerkleRoot(self):
-        return SimpleMerkleRoot(self.hashes, self.hash_function)
+        return SimpleMerkleRoot(list(self.hashes), self.hash_function)
 
     ####
     ## DIAG Helpers:
@@ -95,10 +199,34 @@ class HashLadder:
         # Intended for diagnostics
         for h,p,t in zip(self.hashes, self.preimages, self.pretexts):
             print("%s %s %s"%(t,p.hex(),h.hex()))
-        merk = SimpleMerkleRoot(self.hashes, self.hash_function)
+        merk = self.getMerkleRoot()
         print("Merkle Root: %s" % merk.hex())
 
 
+class _LadderLevels:
+    # Read-only sequence view of one column (0: pretexts, 1: preimages,
+    # 2: hashes) of a checkpointed HashLadder.
+    def __init__(self, ladder, column):
+        self.ladder = ladder
+        self.column = column
+
+    def __len__(self):
+        return self.ladder.numhashes
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("ladder index out of range")
+        return self.ladder.getLevel(i)[self.column]
+
+    def __iter__(self):
+        for level in self.ladder.iterLevels():
+            yield level[self.column]
+
+
 ####
 ## Class:  HashTable
 ##
@@ -110,7 +238,8 @@ class HashTable:
         pass
 
     def __init__(self, targetdate, pricepair, priceiter, secret, cfg,
-                 plane=1, flip=False, hash_function=hashlib.sha256):
+                 plane=1, flip=False, hash_function=hashlib.sha256, checkpoint=None,
+                 cache=None):
 
         if isinstance(targetdate, str):
             targetdate = datetime.datetime.strptime(targetdate, "%y%m%d")
@@ -134,7 +263,15 @@ class HashTable:
         self.roothash     =  self.getRootHash(secret)
         self.fingerprint  =  HashTable.getSecretFingerprint(secret)
 
-        self.ladder     = HashLadder(self.header, self.roothash, self.numhashes, hash_function)
+        self.ladder = None
+        if cache is not None:           # (a LadderCache; None on miss or bad entry)
+            self.ladder = cache.load(self.header, self.roothash, self.numhashes,
+                                     hash_function, self.fingerprint)
+        if self.ladder is None:
+            self.ladder = HashLadder(self.header, self.roothash, self.numhashes, hash_function,
+                                     checkpoint=checkpoint)
+            if cache is not None:
+                cache.store(self.ladder, self.fingerprint)
         self.merkleroot = self.ladder.getMerkleRoot()
 
 
@@ -198,7 +335,7 @@ class HashTable:
         # Intended for diagnostics
         for pc,h,p,t in zip(self.prices, self.ladder.hashes, self.ladder.preimages, self.ladder.pretexts):
             print("%g %s %s %s"%(pc, t,p.hex(),h.hex()))
-        merk = SimpleMerkleRoot(self.ladder.hashes, self.ladder.hash_function)
+        merk = self.ladder.getMerkleRoot()
         print("Merkle Root: %s" % merk.hex())
 
 
@@ -228,12 +365,39 @@ class ConfigArgsExtractor:
         return args
 
 
+def _Test_Checkpointed():
+    print ("\nCheckpointed HashLadder Test:\n")
+    import random
+    rng = random.Random(21)
+    root = hashlib.sha256(b"root").digest()
+    eager = HashLadder("d200223:>=:CJS:EUR:t0.5:f3:s24", root, 300)
+    for k in [1, 7, 64, 299, 300, 1000]:
+        lazy = HashLadder(eager.header, root, 300, checkpoint=k, cachesize=16)
+        ok = True
+        for i in [rng.randrange(-300, 300) for _ in range(200)]:    # (random order, negatives)
+            ok &= (lazy.pretexts[i], lazy.preimages[i], lazy.hashes[i]) == \
+                  (eager.pretexts[i], eager.preimages[i], eager.hashes[i])
+            ok &= lazy.getKernel(i % 300) == eager.kernels[i % 300]
+        for sl in [slice(None), slice(5, 50, 3), slice(-10, None), slice(None, None, -7), slice(400, 500)]:
+            ok &= lazy.hashes[sl] == eager.hashes[sl] and lazy.pretexts[sl] == eager.pretexts[sl]
+        ok &= list(lazy.preimages) == eager.preimages and list(lazy.iterKernels()) == eager.kernels
+        ok &= lazy.getMerkleRoot() == eager.getMerkleRoot()
+        try:
+            lazy.hashes[300]
+            ok = False
+        except IndexError:
+            pass
+        print("checkpoint %4d: matches eager ladder: %s" % (k, ok))
+
+
 if __name__ == "__main__":
 
     import PriceIterators
 
     print("Testing...")
 
+    _Test_Checkpointed()
+
     def hashbad(msgbytes):
         # A truly terrible 24-bit hash...
         class AwfulHash:
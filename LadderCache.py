@@ -0,0 +1,202 @@
+# LadderCache.py
+#
+# Local on-disk cache of generated hash ladders.
+#
+# Regenerating a preimage reveal table for a table published weeks ago
+# means rebuilding its ladder from the secret.  A LadderCache keeps each
+# ladder's kernels, preimages and hashes in a fixed-width binary file, so
+# HashTable(..., cache=LC) can load it instead.  Entries are content
+# addressed: the file name is the sha256 of the key
+#
+#   (pretext header, hash function, secret fingerprint)
+#
+# Entry file layout (all integers big-endian):
+#
+#   header:   magic (8), keysize (u32), width (u32), numhashes (u32)
+#   key:      JSON of the key (keysize bytes)
+#   levels:   numhashes records of kernel, preimage, hash (width bytes each)
+#   trailer:  sha256 of everything above
+#
+# An entry is used only if its checksum, key and level count match, and
+# its first kernel is the hash of the table's root hash (so a fingerprint
+# collision cannot serve another secret's ladder).  Anything else is a
+# miss: the entry is deleted and the caller recomputes.  The cache is
+# bounded in entries and bytes; least recently used entries (by file
+# mtime, refreshed on every hit) are evicted first.
+#
+# Entries hold preimages, which are as sensitive as the secret until they
+# are revealed: the cache directory and files are created owner-only.
+#
+#.
+import hashlib
+import json
+import os
+import struct
+from HashLadder import HashLadder
+
+_Magic = b"HLCACHE1"
+_Header = struct.Struct(">8sIII")       # magic, keysize, width, numhashes
+
+
+def _HashName(hash_function):
+    # Name plus test vector, so two different functions with the same name
+    # do not share entries
+    name = getattr(hash_function, "__qualname__", type(hash_function).__name__)
+    return "%s:%s" % (name, hash_function(b"").digest().hex()[:16])
+
+
+class LadderCache:
+
+    def __init__(self, directory, maxentries=4096, maxbytes=256*2**20):
+        self.directory = directory
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    @staticmethod
+    def Key(header, hash_function, fingerprint):
+        return json.dumps([header, _HashName(hash_function), fingerprint]).encode('utf-8')
+
+    def pathOf(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key).hexdigest() + ".ladder")
+
+    def load(self, header, roothash, numhashes, hash_function, fingerprint):
+        # HashLadder from the cache, or None on a miss (missing, corrupt, or
+        # not matching this root hash).
+        key = LadderCache.Key(header, hash_function, fingerprint)
+        path = self.pathOf(key)
+        try:
+            with open(path, "rb") as f:
+                blob = f.read()
+        except OSError:
+            self.misses += 1
+            return None
+        levels = self._parse(blob, key, numhashes)
+        if levels is None or levels[0][0] != hash_function(roothash).digest():
+            self.discard(path)
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError:                 # (evicted meanwhile by another process)
+            pass
+        self.hits += 1
+        kernels, preimages, hashes = zip(*levels)
+        return HashLadder.fromLevels(header, kernels, preimages, hashes, hash_function)
+
+    @staticmethod
+    def _parse(blob, key, numhashes):
+        # List of (kernel, preimage, hash), or None if the entry is bad
+        if len(blob) < _Header.size + 32:
+            return None
+        body, checksum = blob[:-32], blob[-32:]
+        if hashlib.sha256(body).digest() != checksum:
+            return None
+        magic, keysize, width, count = _Header.unpack_from(body)
+        start = _Header.size + keysize
+        if (magic != _Magic or count != numhashes or body[_Header.size:start] != key
+                or len(body) != start + 3*width*count):
+            return None
+        return [(body[a:a+width], body[a+width:a+2*width], body[a+2*width:a+3*width])
+                for a in range(start, len(body), 3*width)]
+
+    def store(self, ladder, fingerprint): # mutates (on disk)
+        # Write an entry for a HashLadder, then evict down to the limits
+        key = LadderCache.Key(ladder.header, ladder.hash_function, fingerprint)
+        path = self.pathOf(key)
+        width = len(ladder.hash_function(b"").digest())
+        parts = [_Header.pack(_Magic, len(key), width, ladder.numhashes), key]
+        for kernel, preimage, hashbytes in zip(ladder.iterKernels(), ladder.preimages, ladder.hashes):
+            parts += [kernel, preimage, hashbytes]
+        body = b"".join(parts)
+        tmp = path + ".tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(body)
+            f.write(hashlib.sha256(body).digest())
+        os.replace(tmp, path)
+        self.evict(keep=path)
+
+    def entries(self):
+        # (mtime, size, path) of every entry, oldest first
+        found = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".ladder"):
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                found.append((st.st_mtime, st.st_size, path))
+        return sorted(found)
+
+    def evict(self, keep=None): # mutates (on disk)
+        # Delete least recently used entries until within maxentries and
+        # maxbytes, sparing the entry at path `keep` (one just stored, which
+        # may be larger than maxbytes on its own).  Returns the number deleted.
+        entries = self.entries()
+        count = len(entries)
+        total = sum(size for _, size, _ in entries)
+        n = 0
+        for _, size, path in entries:
+            if count <= self.maxentries and total <= self.maxbytes:
+                break
+            if path == keep:
+                continue
+            self.discard(path)
+            count -= 1
+            total -= size
+            n += 1
+        return n
+
+    def discard(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def clear(self): # mutates (on disk)
+        for _, _, path in self.entries():
+            self.discard(path)
+
+
+if __name__ == "__main__":
+
+    import tempfile, time
+
+    print("\nLadderCache Test:\n")
+    LC = LadderCache(tempfile.mkdtemp(), maxentries=3)
+    root = hashlib.sha256(b"root").digest()
+    header = "d200110:>=:BTS:USD:t0.5:f7:s24"
+
+    t0 = time.time()
+    L = HashLadder(header, root, 5000)
+    t1 = time.time()
+    LC.store(L, "fingerprint")
+    C = LC.load(header, root, 5000, hashlib.sha256, "fingerprint")
+    t2 = time.time()
+    same = (C.pretexts == L.pretexts and C.preimages == L.preimages and C.hashes == L.hashes
+            and C.getMerkleRoot() == L.getMerkleRoot())
+    print("5000 levels: built in %.3fs, cached load in %.3fs, identical: %s" % (t1-t0, t2-t1, same))
+
+    lazy = HashLadder(header, root, 5000, checkpoint=64)
+    LC.store(lazy, "fingerprint")
+    C = LC.load(header, root, 5000, hashlib.sha256, "fingerprint")
+    print("Checkpointed ladder stores the same entry: %s" % (C.hashes == L.hashes))
+
+    print("Wrong root hash misses: %s" % (
+        LC.load(header, hashlib.sha256(b"other").digest(), 5000, hashlib.sha256, "fingerprint") is None))
+    LC.store(L, "fingerprint")
+    path = LC.pathOf(LadderCache.Key(header, hashlib.sha256, "fingerprint"))
+    with open(path, "r+b") as f:
+        f.seek(1000)
+        f.write(b"X")
+    print("Corrupt entry misses and is removed: %s" % (
+        LC.load(header, root, 5000, hashlib.sha256, "fingerprint") is None and not os.path.exists(path)))
+
+    for k in range(5):
+        LC.store(HashLadder("h%d" % k, root, 10), "fingerprint")
+    print("Eviction keeps %d entries, newest kept: %s" % (
+        len(LC.entries()), LC.load("h4", root, 10, hashlib.sha256, "fingerprint") is not None))
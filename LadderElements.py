@@ -40,6 +40,117 @@ def SimpleMerkleRoot(hashes, hash_function=hashlib.sha256):
     return SimpleMerkleRoot(reduced, hash_function)
 
 
+class MerkleTree:
+    """
+    Full Merkle tree over an ordered list of leaf hashes, with the same
+    root as SimpleMerkleRoot (pairs of consecutive nodes are hashed
+    together; the last node of an odd-length level is carried up
+    unhashed).
+
+    All levels are built iteratively, then stored in one flat buffer of
+    fixed-width nodes: level 0 (the leaves) first, the root last.  When only
+    the root is needed, SimpleMerkleRoot is cheaper (it keeps no levels).
+
+    Inclusion proofs are the list of sibling hashes from leaf to root,
+    skipping levels where the node is carried up.  Positions are implied by
+    the leaf index and the leaf count, so a proof is just hashes:
+
+      tree = MerkleTree(hashes)
+      proof = tree.proof(i)
+      MerkleTree.verify(hashes[i], i, len(hashes), proof, tree.root())
+
+    """
+
+    def __init__(self, hashes, hash_function=hashlib.sha256):
+        self.hash_function = hash_function
+        hashes = list(hashes)
+        if len(hashes) == 0:
+            hashes = [ hash_function(bytes()).digest() ] # Hash of empty data
+        width = len(hash_function(bytes()).digest())
+        if any(len(h) != width for h in hashes):
+            raise ValueError("Leaves must be %d-byte hashes" % width)
+        self.width = width
+        self.nleaves = len(hashes)
+
+        levels = [hashes]
+        while len(levels[-1]) > 1:
+            level = levels[-1]
+            up = [hash_function(l + r).digest() for l, r in zip(level[0::2], level[1::2])]
+            if len(level) % 2:          # (odd node out: carried up unhashed)
+                up.append(level[-1])
+            levels.append(up)
+        self.sizes = [len(level) for level in levels]   # nodes per level
+        self.offsets = [0]                              # first node of each level
+        for n in self.sizes[:-1]:
+            self.offsets.append(self.offsets[-1] + n)
+        self.buffer = b"".join(h for level in levels for h in level)
+
+    def __len__(self):
+        return self.nleaves
+
+    def node(self, level, i):
+        # Hash of node i of the given level (0: leaves)
+        if not 0 <= i < self.sizes[level]:
+            raise IndexError("node index out of range")
+        a = (self.offsets[level] + i) * self.width
+        return bytes(self.buffer[a:a+self.width])
+
+    def root(self):
+        return self.node(len(self.sizes) - 1, 0)
+
+    def proof(self, index):
+        # Sibling hashes proving leaf `index`, from the leaves upward
+        if not 0 <= index < self.nleaves:
+            raise IndexError("leaf index out of range")
+        proof = []
+        for level, n in enumerate(self.sizes[:-1]):
+            sibling = index ^ 1
+            if sibling < n:
+                proof.append(self.node(level, sibling))
+            index //= 2
+        return proof
+
+    @staticmethod
+    def pathRoot(leaf, index, nleaves, proof, hash_function=hashlib.sha256, memo=None):
+        # Root implied by a leaf and its proof, or None if the proof has the
+        # wrong length.  `memo` (a dict) shares work between many proofs.
+        if not 0 <= index < nleaves:
+            return None
+        node = leaf
+        steps = iter(proof)
+        n = nleaves
+        while n > 1:
+            sibling = index ^ 1
+            if sibling < n:
+                other = next(steps, None)
+                if other is None:
+                    return None
+                pre = other + node if index & 1 else node + other
+                if memo is None:
+                    node = hash_function(pre).digest()
+                else:
+                    node = memo.get(pre)
+                    if node is None:
+                        node = memo[pre] = hash_function(pre).digest()
+            index //= 2
+            n = (n + 1) // 2
+        if next(steps, None) is not None:
+            return None
+        return node
+
+    @staticmethod
+    def verify(leaf, index, nleaves, proof, root, hash_function=hashlib.sha256):
+        return MerkleTree.pathRoot(leaf, index, nleaves, proof, hash_function) == root
+
+    @staticmethod
+    def verifyMany(leaves, indices, nleaves, proofs, root, hash_function=hashlib.sha256):
+        # Verify many proofs against one root.  Returns a list of bools.
+        # Interior nodes shared by several proofs are hashed only once.
+        memo = {}
+        return [MerkleTree.pathRoot(leaf, i, nleaves, proof, hash_function, memo) == root
+                for leaf, i, proof in zip(leaves, indices, proofs)]
+
+
 if __name__ == "__main__":
 
     print ("Aye!")
@@ -48,3 +159,36 @@ if __name__ == "__main__":
     hashes = [hashlib.sha256(bytes(s,'utf8')).digest() for s in pretexts]
 
     root = SimpleMerkleRoot(hashes)
+
+    print("\nMerkleTree vs SimpleMerkleRoot:")
+    import random, time
+    rng = random.Random(5)
+    ok = True
+    for n in list(range(0, 70)) + [1000, 1023, 1025]:
+        leaves = [hashlib.sha256(bytes([i % 256, i // 256])).digest() for i in range(n)]
+        tree = MerkleTree(leaves)
+        ok &= tree.root() == SimpleMerkleRoot(leaves)
+        for i in range(n):
+            ok &= MerkleTree.verify(leaves[i], i, n, tree.proof(i), tree.root())
+        if n > 1:
+            bad = bytearray(leaves[0]); bad[0] ^= 1
+            ok &= not MerkleTree.verify(bytes(bad), 0, n, tree.proof(0), tree.root())
+            ok &= not MerkleTree.verify(leaves[1], 0, n, tree.proof(0), tree.root())
+    print("Roots and proofs agree: %s" % ok)
+
+    n = 100000
+    leaves = [hashlib.sha256(i.to_bytes(4, 'big')).digest() for i in range(n)]
+    t0 = time.time()
+    tree = MerkleTree(leaves)
+    t1 = time.time()
+    root = SimpleMerkleRoot(leaves)
+    t2 = time.time()
+    idx = [rng.randrange(n) for _ in range(5000)]
+    proofs = [tree.proof(i) for i in idx]
+    t3 = time.time()
+    good = MerkleTree.verifyMany([leaves[i] for i in idx], idx, n, proofs, tree.root())
+    t4 = time.time()
+    print("%d leaves: tree %.3fs, SimpleMerkleRoot %.3fs; %d proofs verified (%s) in %.3fs" % (
+        n, t1-t0, t2-t1, len(idx), all(good), t4-t3))
+    print("Checking one leaf: %.1fus by proof, vs. %.1fms rebuilding the root from all leaves" % (
+        (t4-t3)/len(idx)*1e6, (t2-t1)*1e3))
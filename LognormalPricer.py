@@ -0,0 +1,383 @@
+# LognormalPricer.py
+#
+# Closed-form expected values of HTLC contract accounts under a lognormal
+# closing-price model.
+#
+# Each tranche pays its hash account when the closing price X is on one
+# side of a threshold K, and its timeout account otherwise.  Valued in a
+# quote asset, the amount paid is  amount * c * X**p  for a constant c and
+# an integer power p (p = 0 for amounts already in the quote asset, +1 or
+# -1 when valued through the underlying pair, and so on for triangulated
+# cross rates).  Under a lognormal model with forward F and total
+# volatility s = vol*sqrt(T):
+#
+#   E[X**p]           =  m  =  F**p * exp(p*(p-1)*s**2/2)
+#   E[X**p; X > K]    =  m * N(d),   d = (ln(F/K) + (p - 1/2)*s**2) / s
+#
+# so the expected value of every account is a sum of weighted normal CDF
+# terms.  No simulation needed.
+#
+# Usage:
+#
+#   LP = LognormalPricer(contract, "USD")       # compile once...
+#   LP.expectedValues(volatility=0.8, horizon=30/365)        # ...reprice often
+#   LP.expectedValues(Price("0.12 BTS:USD"), 0.8, 30/365)
+#
+# Sensitivities (value, delta, gamma, vega) of every account come from the
+# same terms in closed form, batched over contracts and spot prices:
+#
+#   contract.sensitivities(spots, volatility, horizon, quote="USD")
+#   SensitivityBook(contracts, "USD", "BTS:USD").sensitivities(spots, vol, T)
+#
+#.
+import math
+import numpy as np
+from HTLCProductsSim import *
+from StudyStore import RateFactors
+
+try:
+    from scipy.special import ndtr as _ndtr
+except ImportError:
+    _ndtr = None
+
+# Hart (1968) rational approximation of the lower tail, as given by West,
+# "Better approximations to cumulative normal functions" (absolute error
+# within double precision), with a continued fraction beyond |x| = 5*sqrt(2)
+_HartP = [3.52624965998911e-02, 0.700383064443688, 6.37396220353165, 33.912866078383,
+          112.079291497871, 221.213596169931, 220.206867912376]
+_HartQ = [8.83883476483184e-02, 1.75566716318264, 16.064177579207, 86.7807322029461,
+          296.564248779674, 637.333633378831, 793.826512519948, 440.413735824752]
+
+def _NormCDF(x):
+    x = np.asarray(x, dtype=float)
+    if _ndtr is not None:
+        return _ndtr(x)
+    z = np.abs(x)
+    with np.errstate(over='ignore', invalid='ignore'):
+        e = np.exp(-0.5*z*z)
+        cf = z + 0.65
+        for k in (4, 3, 2, 1):
+            cf = z + k/cf
+        tail = np.where(z < 7.07106781186547, e*np.polyval(_HartP, z)/np.polyval(_HartQ, z),
+                        e/cf/math.sqrt(2*math.pi))
+    return np.where(x > 0, 1 - tail, tail)
+
+
+class PricingTerms:
+    #
+    # A contract's tranches, flattened into one "term" per tranche for a
+    # given quote asset and underlying pair.  Arrays (one entry per term):
+    #
+    #   threshold  -  K in units of `pair` (-inf: always revealed, +inf: never)
+    #   above      -  True if revealed when X is above K, else when below
+    #   strict     -  strictness of the comparison (matters only when s == 0)
+    #   coef       -  amount * constant part of the rate into `quote`
+    #   power      -  integer power of X in the rate into `quote`
+    #   haccount   -  account index receiving the amount when revealed
+    #   taccount   -  account index receiving the amount otherwise
+    #
+    def __init__(self, contract, quote, pair, fixedprices=[]):
+        if isinstance(pair, str):
+            pair = Pair(pair)
+        self.pair = pair
+        self.quote = quote
+        self.naccounts = len(contract.accounts)
+        acctidx = {id(a): i for i, a in enumerate(contract.accounts)}
+        rates = {}
+        threshold, above, strict, coef, power, haccount, taccount = [], [], [], [], [], [], []
+        for t in contract.tranches:
+            if id(t.taccount) not in acctidx or id(t.haccount) not in acctidx:
+                raise ValueError("Tranche disburses to an account not in contract")
+            oh = t.ohash
+            if not oh.threshprice.pair.compat(pair):
+                price = PriceEnvironment.lookup(fixedprices, oh.threshprice.pair)
+                if price is None:
+                    raise ValueError("No compatible price in knownprices")
+                K, up, st = (-math.inf if oh.isRevealed(price) else math.inf), True, False
+            elif type(oh) is not OracleHash:
+                raise ValueError("Cannot price %s analytically" % type(oh).__name__)
+            elif oh.threshprice.pair.same(pair):
+                K, up, st = oh.threshprice.price, oh.exceeds, oh.strict
+            elif oh.threshprice.price <= 0:     # 1/X always above a non-positive threshold
+                K, up, st = (-math.inf if oh.exceeds else math.inf), True, False
+            else:                               # 1/X >= t  <=>  X <= 1/t
+                K, up, st = 1/oh.threshprice.price, not oh.exceeds, oh.strict
+            if t.asset.symbol not in rates:
+                c, (p,) = RateFactors(t.asset.symbol, quote, [pair], fixedprices)
+                rates[t.asset.symbol] = (c, p)
+            c, p = rates[t.asset.symbol]
+            threshold.append(K)
+            above.append(up)
+            strict.append(st)
+            coef.append(t.asset.amount * c)
+            power.append(p)
+            haccount.append(acctidx[id(t.haccount)])
+            taccount.append(acctidx[id(t.taccount)])
+        self.threshold = np.array(threshold, dtype=float)
+        self.above = np.array(above, dtype=bool)
+        self.strict = np.array(strict, dtype=bool)
+        self.coef = np.array(coef, dtype=float)
+        self.power = np.array(power, dtype=float)
+        self.haccount = np.array(haccount, dtype=int)
+        self.taccount = np.array(taccount, dtype=int)
+
+    def __len__(self):
+        return len(self.threshold)
+
+    def moments(self, spots, volatility, horizon, drift=0.0):
+        # Returns (m, R), each shaped (terms, len(spots)):
+        #   m  -  E[X**p]                 (total paid, in quote, per unit coef)
+        #   R  -  E[X**p; revealed]       (paid to the hash account, per unit coef)
+        g = _TermGreeks(self, np.asarray(spots, dtype=float)[None, :], volatility, horizon, drift)
+        return g['m'], g['R']
+
+    def sensitivities(self, spots, volatility, horizon, drift=0.0):
+        # Dict of ndarrays (accounts, len(spots)) with keys:
+        #   value  -  expected account value in quote
+        #   delta  -  d(value)/d(spot)
+        #   gamma  -  d2(value)/d(spot)2
+        #   vega   -  d(value)/d(volatility)
+        g = _TermGreeks(self, np.asarray(spots, dtype=float)[None, :], volatility, horizon, drift)
+        coef = self.coef[:, None]
+        return {key: self.accountSums(coef*g[r], coef*(g[m] - g[r])) for key, m, r in _Greeks}
+
+    def accountSums(self, hashpart, timeoutpart):
+        # Scatter per-term (terms, nspots) quantities into (accounts, nspots)
+        nspots = hashpart.shape[1]
+        cols = np.arange(nspots)[None, :]
+        idx = np.concatenate([(self.haccount[:, None]*nspots + cols).ravel(),
+                              (self.taccount[:, None]*nspots + cols).ravel()])
+        weights = np.concatenate([hashpart.ravel(), timeoutpart.ravel()])
+        return np.bincount(idx, weights, minlength=self.naccounts*nspots).reshape(self.naccounts, nspots)
+
+    def expectedValues(self, spots, volatility, horizon, drift=0.0):
+        # ndarray (accounts, len(spots)) of expected account values in quote
+        m, R = self.moments(spots, volatility, horizon, drift)
+        coef = self.coef[:, None]
+        return self.accountSums(coef*R, coef*(m - R))
+
+
+_Greeks = [("value", 'm', 'R'), ("delta", 'dm', 'dR'), ("gamma", 'd2m', 'd2R'), ("vega", 'vm', 'vR')]
+
+def _TermGreeks(terms, S, volatility, horizon, drift):
+    # Per-term moments and their derivatives, for spots S shaped (1, nspots)
+    # and volatility/horizon either scalars or shaped (terms, 1).
+    #
+    # With U = E[X**p; X > K] = m N(d) and m = C S**p:
+    #
+    #   dU/dS    =  m/S    * (p N + phi/s)
+    #   d2U/dS2  =  m/S**2 * ((p-1)(p N + phi/s) + p phi/s - d phi/s**2)
+    #   dU/dvol  =  sqrt(T) * m * (p(p-1) s N + phi (2p - 1 - d/s))
+    #
+    K = terms.threshold[:, None]
+    p = terms.power[:, None]
+    above = terms.above[:, None]
+    vol = np.asarray(volatility, dtype=float)
+    sqrtT = np.sqrt(np.asarray(horizon, dtype=float))
+    s = vol*sqrtT
+    F = S*np.exp(drift*np.asarray(horizon, dtype=float))
+    m = F**p * np.exp(p*(p-1)*s*s/2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d = (np.log(F/K) + (p-0.5)*s*s)/s
+        ge = above ^ terms.strict[:, None]      # deterministic close: X >= K or X > K
+        d = np.where(K > 0, d, math.inf)
+        d = np.where(s > 0, d, np.where(np.where(ge, F >= K, F > K), math.inf, -math.inf))
+        N = _NormCDF(d)
+        phi = np.where(np.isfinite(d), np.exp(-0.5*d*d), 0.0)/math.sqrt(2*math.pi)
+        phis = np.where(phi > 0, phi/s, 0.0)
+        dphis = np.where(phi > 0, d*phi/s, 0.0)
+        U = m*N
+        dU = m/S*(p*N + phis)
+        d2U = m/(S*S)*((p-1)*(p*N + phis) + p*phis - dphis/s)
+        vU = sqrtT*m*(p*(p-1)*s*N + phi*(2*p - 1) - dphis)
+        d2U = np.where(phi > 0, d2U, m/(S*S)*(p-1)*p*N)
+    dm = p*m/S
+    d2m = p*(p-1)*m/(S*S)
+    vm = sqrtT*p*(p-1)*s*m
+    pick = lambda u, mm: np.where(above, u, mm - u)
+    return {'m': m, 'dm': dm, 'd2m': d2m, 'vm': vm,
+            'R': pick(U, m), 'dR': pick(dU, dm), 'd2R': pick(d2U, d2m), 'vR': pick(vU, vm)}
+
+
+class SensitivityBook:
+    #
+    # A book of contracts compiled into one table of pricing terms, for
+    # batched valuation and sensitivities over many spot prices at once.
+    #
+    #   book = SensitivityBook(contracts, "USD", pair="BTS:USD")   # compile once
+    #   g = book.sensitivities(spots, volatility, horizon)         # reprice often
+    #   g["delta"][c, a, k]   # delta of account a of contract c at spots[k]
+    #
+    # `volatility` and `horizon` may be scalars or per-contract arrays.
+    # Results are ndarrays (contracts, max accounts, spots), NaN-padded for
+    # contracts with fewer accounts.
+    #
+    # Terms alike in threshold, side, strictness, power (and volatility and
+    # horizon) share their normal CDF evaluations; in a book of similar
+    # contracts there are few distinct ones.
+    #
+    def __init__(self, contracts, quote, pair, fixedprices=[]):
+        if isinstance(pair, str):
+            pair = Pair(pair)
+        parts = [PricingTerms(c, quote, pair, fixedprices) for c in contracts]
+        self.ncontracts = len(parts)
+        self.maxaccounts = max([t.naccounts for t in parts], default=0)
+        self.counts = np.array([len(t) for t in parts], dtype=int)
+        self.naccounts = np.array([t.naccounts for t in parts], dtype=int)
+        offsets = np.repeat(np.arange(self.ncontracts)*self.maxaccounts, self.counts)
+        cat = lambda name: np.concatenate([getattr(t, name) for t in parts]) if parts else np.zeros(0)
+        self.terms = PricingTerms.__new__(PricingTerms)
+        self.terms.pair = pair
+        self.terms.quote = quote
+        self.terms.naccounts = self.ncontracts*self.maxaccounts
+        for name in ["threshold", "coef", "power"]:
+            setattr(self.terms, name, cat(name).astype(float))
+        for name in ["above", "strict"]:
+            setattr(self.terms, name, cat(name).astype(bool))
+        self.terms.haccount = cat("haccount").astype(int) + offsets
+        self.terms.taccount = cat("taccount").astype(int) + offsets
+        self._key = np.column_stack([self.terms.threshold, self.terms.above,
+                                     self.terms.strict, self.terms.power])
+        self._merged = self._merge(self._key)
+
+    def _perTerm(self, x):
+        x = np.asarray(x, dtype=float)
+        return x if x.ndim == 0 else np.repeat(x, self.counts)[:, None]
+
+    def _merge(self, key):
+        # Distinct rows of key: (distinct terms, index of the first book term
+        # like each, index of each book term among them, and (hash, timeout)
+        # coef sums as (accounts, distinct) matrices, or None if too large)
+        codes = np.zeros(len(key), dtype=int)
+        for col in key.T:               # (much faster than np.unique(axis=0))
+            values, code = np.unique(col, return_inverse=True)
+            codes = np.unique(codes*len(values) + code, return_inverse=True)[1]
+        _, first, inverse = np.unique(codes, return_index=True, return_inverse=True)
+        terms = PricingTerms.__new__(PricingTerms)
+        for name in ["threshold", "above", "strict", "power"]:
+            setattr(terms, name, getattr(self.terms, name)[first])
+        n = len(first)
+        size = self.terms.naccounts*n
+        weights = None
+        if size <= 4*len(key) + 2**16:
+            weights = tuple(np.bincount(acct*n + inverse, self.terms.coef, minlength=size)
+                            .reshape(self.terms.naccounts, n)
+                            for acct in (self.terms.haccount, self.terms.taccount))
+        return terms, first, inverse, weights
+
+    def sensitivities(self, spots, volatility, horizon, drift=0.0):
+        spots = np.atleast_1d(np.asarray(spots, dtype=float))
+        vol, horizon = self._perTerm(volatility), self._perTerm(horizon)
+        if vol.ndim == 0 and horizon.ndim == 0:
+            terms, first, inverse, weights = self._merged
+        else:
+            terms, first, inverse, weights = self._merge(np.column_stack(
+                [self._key] + [x[:, 0] for x in (vol, horizon) if x.ndim > 0]))
+        pick = lambda x: x if x.ndim == 0 else x[first]
+        g = _TermGreeks(terms, spots[None, :], pick(vol), pick(horizon), drift)
+        g = {k: np.broadcast_to(v, (len(terms), len(spots))) for k, v in g.items()}
+        if weights is not None:
+            hw, tw = weights
+            g = {key: hw @ g[r] + tw @ (g[m] - g[r]) for key, m, r in _Greeks}
+        else:
+            coef = self.terms.coef[:, None]
+            g = {key: self.terms.accountSums(coef*g[r][inverse], coef*(g[m] - g[r])[inverse])
+                 for key, m, r in _Greeks}
+        pad = np.arange(self.maxaccounts)[None, :] >= self.naccounts[:, None]
+        out = {}
+        for key, arr in g.items():
+            arr = arr.reshape(self.ncontracts, self.maxaccounts, len(spots))
+            arr[pad] = np.nan
+            out[key] = arr
+        return out
+
+
+class LognormalPricer:
+    #
+    #  contract     -  Any Contract whose tranches use plain OracleHash oracles
+    #  quote        -  Asset symbol in which to express account values
+    #  fixedprices  -  Other known prices (list or PriceEnvironment), if any
+    #  pair         -  Underlying pair; defaults to that of contract.openingbaseprice
+    #
+    def __init__(self, contract, quote, fixedprices=[], pair=None):
+        self.openingbaseprice = getattr(contract, "openingbaseprice", None)
+        if pair is None:
+            if self.openingbaseprice is None:
+                raise ValueError("No underlying pair given or found in contract")
+            pair = self.openingbaseprice.pair
+        self.terms = PricingTerms(contract, quote, pair, fixedprices)
+
+    def _spots(self, spot):
+        if spot is None:
+            spot = self.openingbaseprice
+        if spot is None:
+            raise ValueError("No spot price given or found in contract")
+        if isinstance(spot, str):
+            spot = Price(spot)
+        if isinstance(spot, Price):
+            if spot.pair.same(self.terms.pair):
+                return [spot.price]
+            if spot.pair.compat(self.terms.pair):
+                return [1/spot.price]
+            raise ValueError("Incompatible prices")
+        return [float(spot)]
+
+    def expectedValues(self, spot=None, volatility=0.0, horizon=1.0, drift=0.0):
+        # List of expected account values (in quote) at close, for a closing
+        # price lognormally distributed about `spot` (default: opening price).
+        return list(self.terms.expectedValues(self._spots(spot), volatility, horizon, drift)[:, 0])
+
+    def sensitivities(self, spots, volatility, horizon=1.0, drift=0.0):
+        # Dict of ndarrays (accounts, len(spots)): value, delta, gamma, vega.
+        # `spots` is a sequence of Prices or of plain numbers in pair units.
+        spots = [self._spots(s)[0] for s in spots]
+        return self.terms.sensitivities(spots, volatility, horizon, drift)
+
+
+if __name__ == "__main__":
+
+    import io, contextlib, time
+    from BoundedStableCoin import BoundedStableCoin
+    from OptionSwap import LongCall
+    from MonteCarlo import MonteCarlo
+
+    with contextlib.redirect_stdout(io.StringIO()):   # (Face() prints its series)
+        BSC = BoundedStableCoin.Face("100 USD", "0.10 BTS:USD", 4, 1.10)
+    LC = LongCall(AssetBag("10000 BTS"), Price("0.05 BTS:USD"), 1.15)
+
+    print("\nAnalytic vs Monte Carlo, 80% vol, 30 days:\n")
+    for name, C, spot in [("BSC", BSC, None), ("LongCall", LC, Price("0.05 BTS:USD"))]:
+        LP = LognormalPricer(C, "USD", pair="BTS:USD")
+        t0 = time.time()
+        ev = LP.expectedValues(spot, 0.8, 30/365)
+        dt = time.time() - t0
+        mc = MonteCarlo(C, 0.8, 30/365, openingbaseprice=spot).run("USD", 400000, seed=3)
+        for a in range(len(ev)):
+            print("%-8s acct %d:  analytic %10.4f   MC %10.4f +/- %.4f   (%.0f us)" % (
+                name, a, ev[a], mc.mean()[a], mc.stderr()[a], dt*1e6))
+
+    print("\nSensitivities vs finite differences (LongCall, acct 0):\n")
+    LP = LognormalPricer(LC, "USD", pair="BTS:USD")
+    g = LP.sensitivities([0.04, 0.05, 0.06], 0.8, 30/365)
+    h = 1e-5
+    for k, S in enumerate([0.04, 0.05, 0.06]):
+        v = lambda S, vol=0.8: LP.expectedValues(S, vol, 30/365)[0]
+        print("  S=%.2f  delta %10.2f (fd %10.2f)  gamma %10.0f (fd %10.0f)  vega %8.3f (fd %8.3f)" % (
+            S, g["delta"][0, k], (v(S+h) - v(S-h))/(2*h),
+            g["gamma"][0, k], (v(S+h) - 2*v(S) + v(S-h))/(h*h),
+            g["vega"][0, k], (v(S, 0.8+h) - v(S, 0.8-h))/(2*h)))
+
+    print("\nBook of 10000 contracts:\n")
+    with contextlib.redirect_stdout(io.StringIO()):
+        book = [BoundedStableCoin.Face("%d USD" % (100 + i % 50), "0.10 BTS:USD", 4, 1.10)
+                if i % 2 else LongCall(AssetBag("%d BTS" % (1000 + i)), Price("0.05 BTS:USD"))
+                for i in range(10000)]
+    t0 = time.time()
+    SB = SensitivityBook(book, "USD", "BTS:USD")
+    t1 = time.time()
+    print("  compile %.2fs" % (t1-t0))
+    for nspots in [1, 20, 100]:
+        t1 = time.time()
+        g = SB.sensitivities(np.linspace(0.06, 0.14, nspots), 0.8, 30/365)
+        t2 = time.time()
+        print("  sensitivities at %3d spots %.3fs, shape %s" % (nspots, t2-t1, g["delta"].shape))
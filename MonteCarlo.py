@@ -0,0 +1,139 @@
+# MonteCarlo.py
+#
+# Monte Carlo payoff distributions for HTLC contracts.
+#
+# Closing prices of the contract's underlying pair are sampled from a
+# lognormal (geometric Brownian motion) model starting at the opening base
+# price, in large batches.  Each batch is settled with the vectorized
+# CompiledContract engine and valued in a chosen quote asset.  Batches may
+# be spread over a process pool; every batch draws from its own child of a
+# single SeedSequence, so results are reproducible and do not depend on the
+# number of workers.
+#
+# Usage:
+#
+#   MC = MonteCarlo(contract, volatility=0.8, horizon=30/365)
+#   R = MC.run("USD", nsamples=10**6, seed=42, workers=4)
+#   R.mean(), R.std(), R.quantiles([0.05, 0.5, 0.95])
+#
+# Works with any Contract (BoundedStableCoin, LongCall, user subclasses).
+# Contracts without an `openingbaseprice` member need one passed in.
+#
+#.
+import concurrent.futures
+import numpy as np
+from HTLCProductsSim import *
+from StudyStore import StudyStore
+
+
+def _SettleBatch(args):
+    # Worker: sample one batch of closing prices and return the valuation of
+    # every account, as an ndarray (accounts, n).
+    compiled, openprice, volatility, horizon, drift, fixedprices, quote, seedseq, n = args
+    rng = np.random.default_rng(seedseq)
+    z = rng.standard_normal(n)
+    X = openprice.price * np.exp((drift - 0.5*volatility**2)*horizon + volatility*np.sqrt(horizon)*z)
+    balances, first = compiled.settle([(openprice.pair, X)], fixedprices)
+    store = StudyStore.fromSettlement(openprice.pair, X, compiled.symbols, balances, first, len(compiled))
+    return np.array([store.valuation(a, quote, fixedprices) for a in range(compiled.naccounts)])
+
+
+class MonteCarloResult:
+    #
+    # Sampled account valuations, shape (accounts, nsamples), in `quote`.
+    #
+    def __init__(self, samples, quote, names):
+        self.samples = samples
+        self.quote = quote
+        self.names = names
+
+    def mean(self):
+        return self.samples.mean(axis=1)
+
+    def variance(self):
+        return self.samples.var(axis=1, ddof=1)
+
+    def std(self):
+        return np.sqrt(self.variance())
+
+    def stderr(self):
+        # Standard error of the mean estimates
+        return self.std() / np.sqrt(self.samples.shape[1])
+
+    def quantiles(self, q):
+        # ndarray (accounts, len(q)) of sample quantiles
+        return np.quantile(self.samples, q, axis=1).T
+
+    def prettyPrint(self, q=(0.05, 0.5, 0.95)):
+        qq = self.quantiles(q)
+        print("%d samples, values in %s:" % (self.samples.shape[1], self.quote))
+        for a, name in enumerate(self.names):
+            print("  %s" % name)
+            print("    mean %g (+/- %g), std %g" % (self.mean()[a], self.stderr()[a], self.std()[a]))
+            print("    " + ", ".join("q%g: %g" % (qi, v) for qi, v in zip(q, qq[a])))
+
+
+class MonteCarlo:
+    #
+    #  contract          -  Any Contract
+    #  volatility        -  Annualized lognormal volatility of the underlying
+    #  horizon           -  Time to close, in years
+    #  drift             -  Annualized drift of the underlying (0 = martingale)
+    #  openingbaseprice  -  (Price) Starting price; defaults to contract.openingbaseprice
+    #  fixedprices       -  Other known prices (list or PriceEnvironment), if any
+    #
+    def __init__(self, contract, volatility, horizon=1.0, drift=0.0,
+                 openingbaseprice=None, fixedprices=[]):
+        if openingbaseprice is None:
+            openingbaseprice = getattr(contract, "openingbaseprice", None)
+        if openingbaseprice is None:
+            raise ValueError("No opening base price given or found in contract")
+        if isinstance(openingbaseprice, str):
+            openingbaseprice = Price(openingbaseprice)
+        self.openingbaseprice = openingbaseprice
+        self.volatility = volatility
+        self.horizon = horizon
+        self.drift = drift
+        self.fixedprices = list(fixedprices)
+        self.compiled = contract.compile()
+        self.names = [getattr(ac, "name", "Account %d" % i) for i, ac in enumerate(contract.accounts)]
+
+    def run(self, quote, nsamples=100000, batchsize=65536, seed=None, workers=None):
+        # Sample `nsamples` closing prices and value every account in `quote`.
+        # workers: number of worker processes (None or 1 for in-process).
+        if nsamples <= 0:
+            raise ValueError("nsamples must be positive")
+        if batchsize <= 0:
+            raise ValueError("batchsize must be positive")
+        nbatches = -(-nsamples // batchsize)
+        seeds = np.random.SeedSequence(seed).spawn(nbatches)
+        sizes = [batchsize]*(nbatches-1) + [nsamples - batchsize*(nbatches-1)]
+        jobs = [(self.compiled, self.openingbaseprice, self.volatility, self.horizon, self.drift,
+                 self.fixedprices, quote, ss, n) for ss, n in zip(seeds, sizes)]
+        if workers is None or workers <= 1:
+            batches = list(map(_SettleBatch, jobs))
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                batches = list(pool.map(_SettleBatch, jobs))
+        return MonteCarloResult(np.concatenate(batches, axis=1), quote, self.names)
+
+
+if __name__ == "__main__":
+
+    import io, contextlib
+    from BoundedStableCoin import BoundedStableCoin
+    from OptionSwap import LongCall
+
+    with contextlib.redirect_stdout(io.StringIO()):   # (Face() prints its series)
+        BSC = BoundedStableCoin.Face("100 USD", "0.10 BTS:USD", 4, 1.10)
+
+    print("\nBounded Stable Coin, 80% vol, 30 days:\n")
+    MC = MonteCarlo(BSC, volatility=0.8, horizon=30/365)
+    R1 = MC.run("USD", nsamples=200000, seed=7)
+    R1.prettyPrint()
+    R4 = MC.run("USD", nsamples=200000, seed=7, workers=4)
+    print("\nSame results with 4 workers: %s" % np.array_equal(R1.samples, R4.samples))
+
+    print("\nLong Call, 80% vol, 30 days:\n")
+    LC = LongCall(AssetBag("10000 BTS"), Price("0.05 BTS:USD"), 1.15)
+    MonteCarlo(LC, 0.8, 30/365, openingbaseprice="0.05 BTS:USD").run("USD", 200000, seed=7).prettyPrint()
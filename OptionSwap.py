@@ -33,7 +33,7 @@ if __name__ == "__main__":
 
     C = LongCall(AssetBag("10000 BTS"), Price("0.05 BTS:USD"), 1.15)
 
-    P = Price.linspace(0, 0.10, 200, "BTS:USD")
+    P = PriceRange(0, 0.10, 200, "BTS:USD")
     C.doStudy(P[1:])
 
     SP = ProductPlot(C, 0, "USD")
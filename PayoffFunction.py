@@ -0,0 +1,290 @@
+# PayoffFunction.py
+#
+# Exact representation of the payoff of a Contract against one price axis.
+#
+# Every tranche conditioned on an OracleHash pays either its hash account
+# or its timeout account depending on which side of a single threshold the
+# closing price falls.  A Contract's payoff is therefore piecewise constant
+# in the closing price, and is fully described by the sorted list of
+# thresholds ("breakpoints") together with the account balances on each
+# open interval between them and at each breakpoint itself (where GE/GT and
+# LE/LT semantics differ).
+#
+# Usage:
+#
+#   PF = PayoffFunction(contract, "BTS:USD", fixedprices)  # or: contract.payoff(...)
+#   PF.evaluate(Price(0.07, "BTS:USD"))   # list of Accounts, O(log n)
+#   PF.balancesMany(values)               # ndarray (N, accounts, symbols)
+#
+# or simply:
+#
+#   contract.doStudy(varprices, fixedprices, engine="breakpoints")
+#
+#.
+import bisect
+import math
+import numpy as np
+from HTLCProductsSim import *
+from StudyStore import StudyStore
+
+
+# Reveal state of an oracle (below, at, above) its threshold, keyed by
+# (exceeds, strict):
+_EdgeStates = {
+    (True, False):  (False, True, True),    # GE
+    (True, True):   (False, False, True),   # GT
+    (False, False): (True, True, False),    # LE
+    (False, True):  (True, False, False),   # LT
+}
+
+
+def _InverseEdges(thresh):
+    # For a threshold t > 0 on the inverse pair, OracleHash compares 1/x with
+    # t.  Since 1/x is monotone in x, 1/x > t, == t, < t hold on consecutive
+    # runs of floats x > 0.  Returns (first x with 1/x <= t, first x with
+    # 1/x < t); the run where 1/x == t lies between them and may be empty.
+    x = 1/thresh
+    while 1/x > thresh:
+        x = math.nextafter(x, math.inf)
+    while 1/math.nextafter(x, 0) <= thresh:
+        x = math.nextafter(x, 0)
+    first = x
+    while 1/x >= thresh:
+        x = math.nextafter(x, math.inf)
+    return first, x
+
+
+class PayoffFunction:
+    #
+    # Piecewise-constant payoff of `contract` as a function of the price of
+    # `pair`, all other prices held at `fixedprices`.
+    #
+    #   breakpoints  -  sorted list of k distinct threshold prices (in `pair` units)
+    #   intervals    -  ndarray (k+1, accounts, symbols): balances on the open
+    #                   intervals (-inf,b0), (b0,b1), ..., (b[k-1],inf)
+    #   points       -  ndarray (k, accounts, symbols): balances at each breakpoint
+    #
+    # Tranches on the inverse of `pair` are supported for positive prices:
+    # threshold t becomes a breakpoint near 1/t with its direction mirrored,
+    # placed on the exact floats where 1/x crosses t, so the balances at
+    # every price are those Contract.conclude() gives.  In fixed-point mode
+    # (see AssetBag.setFixedPoint) balances are summed in integer units.
+    #
+    def __init__(self, contract, pair, fixedprices=[]):
+        if isinstance(pair, str):
+            pair = Pair(pair)
+        self.pair = pair
+        self.contract = contract
+        self.naccounts = len(contract.accounts)
+        acctidx = {id(a): i for i, a in enumerate(contract.accounts)}
+        self.symbols = []
+        symidx = {}
+
+        legs = []       # (account-if-hidden, account-if-revealed, symbol, amount)
+        states = []     # current reveal state of each leg
+        edges = []      # (breakpoint, state at, state after, legindex)
+        for t in contract.tranches:
+            if id(t.taccount) not in acctidx or id(t.haccount) not in acctidx:
+                raise ValueError("Tranche disburses to an account not in contract")
+            if t.asset.symbol not in symidx:
+                symidx[t.asset.symbol] = len(self.symbols)
+                self.symbols.append(t.asset.symbol)
+            amount = t.asset.amount
+            if AssetBag.fixedpoint:         # (sum in integer units)
+                amount = AssetBag.toUnits(amount, t.asset.symbol)
+            legs.append((acctidx[id(t.taccount)], acctidx[id(t.haccount)],
+                         symidx[t.asset.symbol], amount))
+            oh = t.ohash
+            if not oh.threshprice.pair.compat(pair):
+                states.append(self._fixedState(oh, fixedprices))
+                continue
+            if type(oh) is not OracleHash:
+                raise ValueError("Cannot derive breakpoints of %s" % type(oh).__name__)
+            below, at, above = _EdgeStates[(oh.exceeds, oh.strict)]
+            thresh = oh.threshprice.price
+            leg = len(legs)-1
+            if oh.threshprice.pair.same(pair):
+                states.append(below)
+                edges.append((thresh, at, above, leg))
+                continue
+            if thresh <= 0:                 # 1/x always above a non-positive threshold
+                states.append(oh.exceeds)
+                continue
+            first, after = _InverseEdges(thresh)    # x < first: 1/x above t
+            states.append(above)
+            if math.nextafter(first, math.inf) == after:
+                edges.append((first, at, below, leg))
+            else:                           # (no x, or many, with 1/x == t)
+                if first < after:
+                    edges.append((first, at, at, leg))
+                edges.append((after, below, below, leg))
+        edges.sort(key=lambda e: e[0])
+
+        shape = (self.naccounts, len(self.symbols))
+        bal = np.zeros(shape, dtype=np.int64 if AssetBag.fixedpoint else float)
+        count = np.zeros(shape, dtype=int)
+
+        def deliver(leg, revealed, sign):
+            tacct, hacct, sym, amount = legs[leg]
+            acct = hacct if revealed else tacct
+            count[acct, sym] += sign
+            bal[acct, sym] = bal[acct, sym] + sign*amount if count[acct, sym] else 0
+
+        def move(leg, newstate):
+            if states[leg] != newstate:
+                deliver(leg, states[leg], -1)
+                deliver(leg, newstate, +1)
+                states[leg] = newstate
+
+        for leg in range(len(legs)):
+            deliver(leg, states[leg], +1)
+
+        self.breakpoints = []
+        intervals = [(bal.copy(), count > 0)]
+        points = []
+        i = 0
+        while i < len(edges):
+            j = i
+            while j < len(edges) and edges[j][0] == edges[i][0]:
+                j += 1
+            for _, at, _, leg in edges[i:j]:
+                move(leg, at)
+            points.append((bal.copy(), count > 0))
+            for _, _, after, leg in edges[i:j]:
+                move(leg, after)
+            intervals.append((bal.copy(), count > 0))
+            self.breakpoints.append(edges[i][0])
+            i = j
+
+        unitsize = 1.0
+        if AssetBag.fixedpoint:
+            unitsize = np.array([10**AssetBag.precisions[s] for s in self.symbols], dtype=float)
+        self.intervals = np.array([b for b, _ in intervals]).reshape((-1,) + shape) / unitsize
+        self.ipresent = np.array([p for _, p in intervals]).reshape((-1,) + shape)
+        self.points = np.array([b for b, _ in points]).reshape((-1,) + shape) / unitsize
+        self.ppresent = np.array([p for _, p in points]).reshape((-1,) + shape)
+        self._bparray = np.array(self.breakpoints, dtype=float)
+
+    @staticmethod
+    def _fixedState(ohash, fixedprices):
+        price = PriceEnvironment.lookup(fixedprices, ohash.threshprice.pair)
+        if price is None:
+            raise ValueError("No compatible price in knownprices")
+        return bool(ohash.isRevealed(price))
+
+    def _value(self, price):
+        # Accept a Price (in pair or inverse pair) or a plain number in pair units
+        if isinstance(price, Price):
+            if price.pair.same(self.pair):
+                return price.price
+            if price.pair.compat(self.pair):
+                return 1/price.price
+            raise ValueError("Incompatible prices")
+        return float(price)
+
+    def locate(self, price):
+        # Returns (table, row) holding the balances at `price`.  O(log n).
+        x = self._value(price)
+        i = bisect.bisect_left(self.breakpoints, x)
+        if i < len(self.breakpoints) and self.breakpoints[i] == x:
+            return (self.points, self.ppresent), i
+        return (self.intervals, self.ipresent), i
+
+    def balances(self, price):
+        # ndarray (accounts, symbols) of balances at a single price
+        (table, _), i = self.locate(price)
+        return table[i]
+
+    def evaluate(self, price):
+        # List of Accounts (one per contract account) concluded at `price`
+        (table, present), i = self.locate(price)
+        return [self._account(table[i][a], present[i][a]) for a in range(self.naccounts)]
+
+    def _account(self, row, present):
+        ac = Account()
+        for s in range(len(self.symbols)):
+            if present[s]:
+                ac.deposit(self.symbols[s], float(row[s]))
+        return ac
+
+    def lookupMany(self, values):
+        # Vectorized locate for an ndarray of prices in pair units.  Returns
+        # (balances, present), each shaped (N, accounts, symbols).
+        values = np.asarray(values, dtype=float)
+        idx = np.searchsorted(self._bparray, values, side='left')
+        k = len(self.breakpoints)
+        if k == 0:
+            return self.intervals[idx], self.ipresent[idx]
+        pidx = np.minimum(idx, k-1)
+        exact = (idx < k) & (self._bparray[pidx] == values)
+        sel = exact[:, None, None]
+        return (np.where(sel, self.points[pidx], self.intervals[idx]),
+                np.where(sel, self.ppresent[pidx], self.ipresent[idx]))
+
+    def balancesMany(self, values):
+        return self.lookupMany(values)[0]
+
+    def study(self, varprices):
+        # Breakpoint equivalent of Contract.doStudy(): returns a StudyStore of
+        # the balances of every account at each price in varprices.
+        if isinstance(varprices, PriceRange) and varprices.pair.same(self.pair):
+            values = varprices.values()
+        else:
+            values = np.fromiter((self._value(p) for p in varprices), dtype=float)
+        bal, present = self.lookupMany(values)
+        return StudyStore.fromPresence(self.pair, values, self.symbols,
+                                       bal.transpose(1, 2, 0), present.transpose(1, 2, 0))
+
+    def printTable(self, quote=None, knownprices=[]):
+        # Print the step table: one row per interval and per breakpoint
+        def row(label, table, present, i):
+            accts = [self._account(table[i][a], present[i][a]) for a in range(self.naccounts)]
+            if quote is None:
+                cells = [", ".join(str(b) for b in ac.bags) for ac in accts]
+            else:
+                cells = [str(ac.valuation(quote, knownprices)) for ac in accts]
+            print("%24s  %s" % (label, "  ".join("%16s" % c for c in cells)))
+        bp = self.breakpoints
+        for i in range(len(bp)+1):
+            lo = "-inf" if i == 0 else "%g" % bp[i-1]
+            hi = "inf" if i == len(bp) else "%g" % bp[i]
+            row("(%s, %s)" % (lo, hi), self.intervals, self.ipresent, i)
+            if i < len(bp):
+                row("= %g" % bp[i], self.points, self.ppresent, i)
+
+
+if __name__ == "__main__":
+
+    print("\nPayoff Function Test:\n")
+    C = Contract()
+    C.addNAccounts(2)
+    C.addTranche(OracleHash.GT("12 USD:BTS"), "100 BTS")
+    C.addTranche(OracleHash.GE("11 USD:BTS"), "100 BTS")
+    C.addTranche(OracleHash.LE("0.1 BTS:USD"), "50 USD", 1, 0)
+    C.addTranche(OracleHash.LT("10 USD:BTS"), "100 BTS", 1, 0)
+
+    PF = C.payoff("USD:BTS")
+    PF.printTable()
+
+    P = Price.linspace(7, 13, 25, "USD:BTS")
+    C.doStudy(P)
+    looped = [[ac.valuation("BTS", [p]) for p, ac in zip(P, a.StudyResults)] for a in C.accounts]
+    C.doStudy(P, engine="breakpoints")
+    stepped = [[ac.valuation("BTS", [p]) for p, ac in zip(P, a.StudyResults)] for a in C.accounts]
+    print("\nEngines agree: %s" % all(abs(x.amount - y.amount) < 1e-9
+                                      for a, b in zip(looped, stepped) for x, y in zip(a, b)))
+
+    saved = dict(AssetBag.precisions)
+    AssetBag.setPrecision("BTS", 2)
+    AssetBag.setFixedPoint()
+    F = Contract()
+    F.addNAccounts(2)
+    for i in range(10):
+        F.addTranche(OracleHash.GE("0.10 BTS:USD"), AssetBag(0.333, "BTS"))
+    final = [Price("0.2 BTS:USD")]
+    F.conclude(final)
+    bp = F.payoff("BTS:USD").evaluate(final[0])[1].balances
+    print("Fixed-point: conclude %s, breakpoints %s" % (F.accounts[1].balances, bp))
+    AssetBag.setFixedPoint(False)
+    AssetBag.precisions.clear()
+    AssetBag.precisions.update(saved)
@@ -0,0 +1,275 @@
+# Portfolio.py
+#
+# Settlement of many contracts at once.
+#
+# A Portfolio registers any number of Contracts and flattens all of their
+# tranches into one table of "legs".  Oracle conditions are deduplicated:
+# every distinct (pair, threshold, strict, exceeds) condition appears once
+# in a shared condition table, however many tranches (in however many
+# contracts) depend on it.  Settling against a set of known prices then
+# takes one price lookup per pair, one vectorized comparison per condition
+# table entry, and one scatter-add of every leg into its destination
+# account.
+#
+# Usage:
+#
+#   P = Portfolio(contracts)         # or: P = Portfolio(); P.add(contract)
+#   P.settle([Price("0.08 BTS:USD")])
+#   P.balances(3)                    # ndarray (accounts, symbols) of contract 3
+#   P.accounts(3)                    # ... as a list of Accounts
+#   P.aggregate()                    # ndarray (unique accounts, symbols)
+#   P.conclude(knownprices)          # deposit into the contracts' own accounts
+#
+# Accounts shared between contracts (the same Account object) are combined
+# by aggregate() and by conclude().
+#
+#.
+import numpy as np
+from HTLCProductsSim import *
+
+
+class Portfolio:
+    #
+    #  contracts   -  list of registered Contracts
+    #  symbols     -  list of asset symbols over all contracts
+    #  conditions  -  list of distinct oracles (the shared condition table)
+    #  owners      -  list of distinct Account objects over all contracts
+    #
+    def __init__(self, contracts=[]):
+        self.contracts = []
+        self.symbols = []
+        self.conditions = []
+        self.owners = []
+        self._compiled = None
+        self._settled = None
+        for c in contracts:
+            self.add(c)
+
+    def add(self, contract): # mutates
+        # Register a contract; returns its index within the portfolio
+        self.contracts.append(contract)
+        self._compiled = None
+        return len(self.contracts) - 1
+
+    def __len__(self):
+        return len(self.contracts)
+
+    def _signature(self):
+        # Changes whenever a contract is added or any contract .changed(), or
+        # fixed-point mode is switched
+        return (AssetBag.fixedpoint, tuple((id(c), c.revision) for c in self.contracts))
+
+    def compile(self): # mutates
+        # (Re)build the condition table and leg table.  Called automatically
+        # when contracts are added or any contract has .changed().
+        if self._compiled == self._signature():
+            return self
+        symidx = {}
+        condidx = {}
+        owneridx = {}
+        self.symbols, self.conditions, self.owners = [], [], []
+        self.offsets = []       # first account row of each contract
+        rowowner = []           # owner index of each account row
+        cond, amount, symbol, trow, hrow = [], [], [], [], []
+        for c in self.contracts:
+            self.offsets.append(len(rowowner))
+            rows = {}
+            for ac in c.accounts:
+                rows[id(ac)] = len(rowowner)
+                if id(ac) not in owneridx:
+                    owneridx[id(ac)] = len(self.owners)
+                    self.owners.append(ac)
+                rowowner.append(owneridx[id(ac)])
+            for t in c.tranches:
+                if id(t.taccount) not in rows or id(t.haccount) not in rows:
+                    raise ValueError("Tranche disburses to an account not in contract")
+                oh = t.ohash
+                if type(oh) is OracleHash:
+                    key = (oh.threshprice.pair, oh.threshprice.price, oh.strict, oh.exceeds)
+                else:
+                    key = id(oh)        # (custom oracles are evaluated as they are)
+                if key not in condidx:
+                    condidx[key] = len(self.conditions)
+                    self.conditions.append(oh)
+                if t.asset.symbol not in symidx:
+                    symidx[t.asset.symbol] = len(self.symbols)
+                    self.symbols.append(t.asset.symbol)
+                cond.append(condidx[key])
+                amount.append(t.asset.amount)
+                symbol.append(symidx[t.asset.symbol])
+                trow.append(rows[id(t.taccount)])
+                hrow.append(rows[id(t.haccount)])
+        self.offsets.append(len(rowowner))
+        self.rowowner = np.array(rowowner, dtype=int)
+        self.cond = np.array(cond, dtype=int)
+        self.amount = np.array(amount, dtype=float)
+        self.symbol = np.array(symbol, dtype=int)
+        self.trow = np.array(trow, dtype=int)
+        self.hrow = np.array(hrow, dtype=int)
+        self.units = None       # (int64 amounts, in fixed-point mode)
+        if AssetBag.fixedpoint:
+            self.units = np.array([AssetBag.toUnits(a, self.symbols[s]) for a, s in zip(amount, symbol)],
+                                  dtype=np.int64)
+            self.unitsize = np.array([10**AssetBag.precisions[s] for s in self.symbols], dtype=np.int64)
+
+        # Plain OracleHash conditions, grouped by threshold pair:
+        # pair -> (condition indices, thresholds, strict, exceeds)
+        bypair = {}
+        self.custom = []
+        for i, oh in enumerate(self.conditions):
+            if type(oh) is OracleHash:
+                bypair.setdefault(oh.threshprice.pair, []).append(i)
+            else:
+                self.custom.append(i)
+        self.groups = []
+        for pair, idx in bypair.items():
+            ohs = [self.conditions[i] for i in idx]
+            self.groups.append((pair, np.array(idx, dtype=int),
+                                np.array([oh.threshprice.price for oh in ohs], dtype=float),
+                                np.array([oh.strict for oh in ohs], dtype=bool),
+                                np.array([oh.exceeds for oh in ohs], dtype=bool)))
+        self._compiled = self._signature()
+        self._settled = None
+        return self
+
+    def revealed(self, knownprices):
+        # Bool ndarray: reveal state of each entry of the condition table
+        self.compile()
+        env = PriceEnvironment.wrap(knownprices)
+        revealed = np.zeros(len(self.conditions), dtype=bool)
+        for pair, idx, thresh, strict, exceeds in self.groups:
+            price = env.price(pair)
+            if price is None:
+                raise ValueError("No compatible price in knownprices")
+            revealed[idx] = OracleHash.compareMany(price.price, thresh, strict, exceeds)
+        for i in self.custom:
+            oh = self.conditions[i]
+            price = env.price(oh.threshprice.pair)
+            if price is None:
+                raise ValueError("No compatible price in knownprices")
+            revealed[i] = bool(oh.isRevealed(price))
+        return revealed
+
+    def settle(self, knownprices): # mutates
+        # Settle every contract against knownprices (list of Prices or a
+        # PriceEnvironment).  Contracts' own accounts are left untouched;
+        # read results with balances(), accounts() and aggregate().
+        revealed = self.revealed(knownprices)
+        rows = np.where(revealed[self.cond], self.hrow, self.trow)
+        nsym = len(self.symbols)
+        size = len(self.rowowner)*nsym
+        flat = rows*nsym + self.symbol
+        present = np.bincount(flat, minlength=size).reshape(-1, nsym) > 0
+        if self.units is None:
+            balances = np.bincount(flat, self.amount, minlength=size).reshape(-1, nsym)
+            self._settled = (balances, present, None)
+            return self
+        units = np.zeros(size, dtype=np.int64)      # (exact integer sums)
+        np.add.at(units, flat, self.units)
+        units = units.reshape(-1, nsym)
+        self._settled = (units / self.unitsize, present, units)
+        return self
+
+    def _results(self):
+        if self._settled is None:
+            raise ValueError("Portfolio not settled")
+        return self._settled[:2]
+
+    def balances(self, i):
+        # ndarray (accounts, symbols) of contract i's balances
+        balances, _ = self._results()
+        return balances[self.offsets[i]:self.offsets[i+1]]
+
+    def accounts(self, i):
+        # List of Accounts (one per account of contract i) holding its balances
+        balances, present = self._results()
+        lo, hi = self.offsets[i], self.offsets[i+1]
+        return [self._account(balances[r], present[r]) for r in range(lo, hi)]
+
+    def _account(self, row, present):
+        ac = Account()
+        for s in range(len(self.symbols)):
+            if present[s]:
+                ac.deposit(self.symbols[s], float(row[s]))
+        return ac
+
+    def aggregate(self):
+        # ndarray (len(owners), symbols): balances per distinct Account object,
+        # combined over every contract that disburses to it
+        balances, _ = self._results()
+        units = self._settled[2]
+        if units is not None:
+            total = np.zeros((len(self.owners), len(self.symbols)), dtype=np.int64)
+            np.add.at(total, self.rowowner, units)
+            return total / self.unitsize
+        total = np.zeros((len(self.owners), len(self.symbols)))
+        np.add.at(total, self.rowowner, balances)
+        return total
+
+    def totals(self):
+        # ndarray (symbols,): sum over all accounts of all contracts
+        balances, _ = self._results()
+        units = self._settled[2]
+        if units is not None:
+            return units.sum(axis=0) / self.unitsize
+        return balances.sum(axis=0)
+
+    def conclude(self, knownprices): # mutates
+        # Portfolio equivalent of Contract.conclude() on every contract:
+        # deposits the settled balances into the contracts' own accounts
+        # (one bag per symbol).
+        self.settle(knownprices)
+        balances, present = self._results()
+        held = np.zeros((len(self.owners), len(self.symbols)), dtype=bool)
+        np.logical_or.at(held, self.rowowner, present)
+        total = self.aggregate()
+        for o, ac in enumerate(self.owners):
+            for s in np.flatnonzero(held[o]):
+                ac.deposit(self.symbols[s], float(total[o, s]))
+        for c in self.contracts:
+            c.pricelistcache = knownprices
+
+
+if __name__ == "__main__":
+
+    import io, contextlib, time
+    from BoundedStableCoin import BoundedStableCoin
+    from OptionSwap import LongCall
+
+    with contextlib.redirect_stdout(io.StringIO()):   # (Face() prints its series)
+        book = [BoundedStableCoin.Face("%d USD" % (100 + i % 50), "0.10 BTS:USD", 4, 1.10)
+                if i % 2 else LongCall(AssetBag("%d BTS" % (1000 + i % 7)), Price("0.05 BTS:USD"))
+                for i in range(4000)]
+    P = Portfolio(book).compile()
+    print("\nPortfolio of %d contracts: %d tranches, %d distinct conditions" % (
+        len(P), len(P.cond), len(P.conditions)))
+
+    final = [Price("0.083 BTS:USD")]
+    t0 = time.time()
+    for c in book:
+        c.reset()
+        c.conclude(final)
+    t1 = time.time()
+    P.settle(final)
+    t2 = time.time()
+    print("conclude() one by one %.3fs, Portfolio.settle() %.4fs" % (t1-t0, t2-t1))
+    err = max(abs(P.balances(i)[a, P.symbols.index(b.symbol)] - b.amount)
+              for i, c in enumerate(book) for a, ac in enumerate(c.accounts) for b in ac.bags)
+    print("Max difference: %g" % err)
+    print("Totals: %s" % ", ".join("%g %s" % (v, s) for s, v in zip(P.symbols, P.totals())))
+
+    saved = dict(AssetBag.precisions)
+    AssetBag.setPrecision("BTS", 2)
+    AssetBag.setFixedPoint()
+    F = Contract()
+    F.addNAccounts(2)
+    for i in range(10):
+        F.addTranche(OracleHash.GE("0.10 BTS:USD"), AssetBag(0.333, "BTS"))
+    final = [Price("0.2 BTS:USD")]
+    F.conclude(final)
+    P = Portfolio([F, F]).settle(final)
+    print("Fixed-point: conclude %s, Portfolio %g, aggregated over two copies %g" % (
+        F.accounts[1].balances, P.balances(0)[1, 0], P.aggregate()[1, 0]))
+    AssetBag.setFixedPoint(False)
+    AssetBag.precisions.clear()
+    AssetBag.precisions.update(saved)
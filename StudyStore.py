@@ -0,0 +1,197 @@
+# StudyStore.py
+#
+# Columnar storage for the results of a Contract study.
+#
+# Instead of one Account copy per account per price point, a study writes
+# one float64 column per (account, symbol) over the X axis, plus the X
+# prices themselves as an array.  A small int16 "order" column per
+# (account, symbol) records whether (and in which order) the account held
+# the symbol at each point, so that Account views are exact.
+#
+# Usage:
+#
+#   contract.doStudy(varprices, fixedprices)
+#   store = contract.Study
+#   store.X                                 # ndarray of X prices
+#   store.column(0, "BTS")                  # ndarray of account 0's BTS balance
+#   store.valuation(0, "USD", fixedprices)  # ndarray of account 0's value in USD
+#   contract.accounts[0].StudyResults[k]    # Account view at point k
+#
+#.
+import numpy as np
+from HTLCProductsSim import *
+
+
+def RateFactors(symbol, quote, varying, fixedprices=[]):
+    # Factors the rate of `symbol` in units of `quote` as
+    #
+    #   rate = constant * x1**p1 * x2**p2 * ...
+    #
+    # where x1, x2, ... are the prices of the `varying` pairs (which take
+    # precedence over fixed ones, as in [x]+fixedprices) and p1, p2, ... are
+    # integers.  Cross rates are triangulated through the asset graph of a
+    # PriceEnvironment.  Returns (constant, [p1, p2, ...]).
+    powers = [0]*len(varying)
+    if symbol == quote:
+        return 1, powers
+    placeholders = [Price(1.0, pair) for pair in varying]
+    env = PriceEnvironment(placeholders + list(fixedprices))
+    path = env.path(symbol, quote)
+    if path is None:
+        raise ValueError("No compatible price found in knownprices")
+    constant = 1
+    for a, b in zip(path[:-1], path[1:]):
+        price = env.find(Pair.intern(a, b))
+        direct = price.pair.base == a
+        for i, placeholder in enumerate(placeholders):
+            if price is placeholder:
+                powers[i] += 1 if direct else -1
+                break
+        else:
+            constant = constant * (price.price if direct else 1/price.price)
+    return constant, powers
+
+
+def RateArray(symbol, quote, varying, fixedprices=[]):
+    # Units of `quote` per unit of `symbol` at every point of the `varying`
+    # (Pair, ndarray) axes, as an ndarray (or a plain number if the rate does
+    # not depend on them).  (See RateFactors)
+    constant, powers = RateFactors(symbol, quote, [pair for pair, _ in varying], fixedprices)
+    rate = constant
+    with np.errstate(divide='ignore'):
+        for p, (_, values) in zip(powers, varying):
+            for _ in range(abs(p)):
+                rate = rate * values if p > 0 else rate / values
+    return rate
+
+
+class StudyResultsView:
+    #
+    # Read-only sequence of Account views over one account's column of a
+    # StudyStore.  Stands in for the old list of Account copies in
+    # (Contract).accounts[...].StudyResults.
+    #
+    def __init__(self, store, acct):
+        self.store = store
+        self.acct = acct
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self.store.account(self.acct, i) for i in range(len(self.store))[k]]
+        if k < 0:
+            k += len(self.store)
+        if not 0 <= k < len(self.store):
+            raise IndexError("study index out of range")
+        return self.store.account(self.acct, k)
+
+    def __iter__(self):
+        for k in range(len(self.store)):
+            yield self.store.account(self.acct, k)
+
+
+class StudyStore:
+    #
+    #   xpair     -  Pair of the X axis
+    #   X         -  float64 ndarray (N,) of X prices
+    #   symbols   -  list of asset symbols
+    #   balances  -  float64 ndarray (accounts, symbols, N)
+    #   order     -  int16 ndarray (accounts, symbols, N): position of the
+    #                symbol among the account's bags at that point, or -1
+    #                if the account did not hold it
+    #   start     -  index of the first point within the whole sweep (for
+    #                chunks produced by a streaming study)
+    #   scale     -  factor applied to `balances` on every read (see scaled())
+    #
+    def __init__(self, xpair, X, symbols, balances, order, start=0, scale=1):
+        self.start = start
+        self.scale = scale
+        self.xpair = xpair
+        self.X = X
+        self.symbols = list(symbols)
+        self.balances = balances
+        self.order = order
+        self._symidx = {s: i for i, s in enumerate(self.symbols)}
+
+    @staticmethod
+    def empty(xpair, X, naccounts, symbols):
+        X = np.asarray(X, dtype=float)
+        shape = (naccounts, len(symbols), len(X))
+        return StudyStore(xpair, X, symbols, np.zeros(shape), np.full(shape, -1, dtype=np.int16))
+
+    @staticmethod
+    def fromSettlement(xpair, X, symbols, balances, first, ntranches):
+        # From CompiledContract.settle() output; `first` holds the index of
+        # the tranche that first delivered each (account, symbol).
+        ranks = np.argsort(np.argsort(first, axis=1, kind='stable'), axis=1, kind='stable')
+        order = np.where(first < ntranches, ranks, -1).astype(np.int16)
+        return StudyStore(xpair, X, symbols, balances, order)
+
+    @staticmethod
+    def fromPresence(xpair, X, symbols, balances, present):
+        # From (accounts, symbols, N) balances and a presence mask; bags are
+        # ordered by symbol.
+        order = np.where(present, np.cumsum(present, axis=1) - 1, -1).astype(np.int16)
+        return StudyStore(xpair, X, symbols, balances, order)
+
+    def __len__(self):
+        return len(self.X)
+
+    def scaled(self, factor):
+        # View of this store with every balance multiplied by `factor`.
+        # Shares the X, balances and order arrays; nothing is copied.
+        return StudyStore(self.xpair, self.X, self.symbols, self.balances, self.order,
+                          self.start, self.scale*factor)
+
+    @property
+    def naccounts(self):
+        return self.balances.shape[0]
+
+    def record(self, k, accounts): # mutates
+        # Store the balances of a list of concluded Accounts as point k
+        for a, ac in enumerate(accounts):
+            for rank, (symbol, amount) in enumerate(ac.balances.items()):
+                s = self._symidx[symbol]
+                self.balances[a, s, k] = amount
+                self.order[a, s, k] = rank
+
+    def column(self, acct, symbol):
+        # float64 balance of `symbol` held by account `acct` over the X axis
+        column = self.balances[acct, self._symidx[symbol]]
+        return column if self.scale == 1 else column*self.scale
+
+    def account(self, acct, k):
+        # Account view of account `acct` at point k
+        ranked = [(self.order[acct, s, k], s) for s in range(len(self.symbols))
+                  if self.order[acct, s, k] >= 0]
+        ac = Account()
+        for _, s in sorted(ranked):
+            ac.deposit(self.symbols[s], float(self.balances[acct, s, k]*self.scale))
+        return ac
+
+    def results(self, acct):
+        return StudyResultsView(self, acct)
+
+    def records(self):
+        # Yields (Price, [ {symbol: amount} per account ]) for each point
+        for k in range(len(self)):
+            yield (Price(float(self.X[k]), self.xpair),
+                   [self.account(a, k).balances for a in range(self.naccounts)])
+
+    def prices(self):
+        # X axis as a list of Price objects
+        return [Price(float(x), self.xpair) for x in self.X]
+
+    def valuation(self, acct, quote, fixedprices=[]):
+        # float64 value of account `acct` in units of `quote` over the X axis
+        value = np.zeros(len(self))
+        for s, symbol in enumerate(self.symbols):
+            held = self.order[acct, s] >= 0
+            if not held.any():
+                continue
+            rate = RateArray(symbol, quote, [(self.xpair, self.X)], fixedprices)
+            with np.errstate(invalid='ignore'):
+                value += np.where(held, self.balances[acct, s] * rate, 0.0)
+        return value if self.scale == 1 else value*self.scale
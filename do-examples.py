@@ -22,7 +22,7 @@ if __name__ == '__main__':
         BSC.printAccountValuesLine("USD", firstcoltext=str(price))
     print()
 
-    P = Price.linspace(0, 0.50, 4000, "BTS:USD")
+    P = PriceRange(0, 0.50, 4000, "BTS:USD")
     BSC.doStudy(P)
 
     SP = ProductPlot(BSC, 0, "USD")